@@ -6,13 +6,26 @@
 # ---------------------------
 # Run all tidiness scripts. Could be used by pre-commit.
 
-import os, sys, subprocess
+import os, sys, io, itertools, contextlib, threading
+import tidy_utils.checkers as checkers
+import tidy_utils.diagnostics as diagnostics
 import tidy_utils.git_utils as git_utils
-# tidy script modules
-import dirname_discipline
-import filename_match
-import whitespace
-import clang_format
+import tidy_utils.lazy_import as lazy_import
+import tidy_utils.metrics as metrics
+import tidy_utils.run_context as run_context
+import tidy_utils.parallel as parallel
+import tidy_utils.result_cache as result_cache
+import tidy_utils.scanner as scanner
+import tidy_utils.should_visit as should_visit
+import tidy_utils.tree_walk as tree_walk
+# tidy script modules, each imported when it is first used, as this runs on every commit
+dirname_discipline = lazy_import.load("dirname_discipline")
+filename_match = lazy_import.load("filename_match")
+whitespace = lazy_import.load("whitespace")
+clang_format = lazy_import.load("clang_format")
+
+WATCH_SOCKET = os.path.join(".git", "tidy-watch.sock")
+WATCH_REPLY_TIMEOUT = 2 # seconds; if the watcher does not reply by then, the files are checked here
 
 UNIT_1024 = ['','K','M','G','T','P','E','Z']
 def sizeof_fmt(num, suffix='B'):
@@ -29,7 +42,8 @@ def print_decription(filenames):
     print(" - tidy.whitespace")
     if len(filenames) > 0:
         print("\n".join([
-            "\t%s (%s)" % (item, sizeof_fmt(os.stat(item).st_size)) for item in filenames
+            "\t%s (%s)" % (item, sizeof_fmt(os.stat(item).st_size) if os.path.isfile(item) else "deleted")
+            for item in filenames
         ]))
     else:
         print("\t(no staged created/modified files)")
@@ -38,7 +52,7 @@ def print_stage(silent, content):
     if not silent:
         print(content)
 
-def check_each_status(dirname_passed, whitespace_passed, filename_passed, clang_format_done):
+def check_each_status(dirname_passed, whitespace_passed, filename_passed, clang_format_done, plugins_passed=()):
     if not dirname_passed:
         print("[x] tidy: error at tidy.dirname_discipline")
     if not filename_passed:
@@ -47,10 +61,18 @@ def check_each_status(dirname_passed, whitespace_passed, filename_passed, clang_
         print("[x] tidy: error at tidy.clang_format")
     if not whitespace_passed:
         print("[x] tidy: error at tidy.whitespace")
-    return all([dirname_passed, whitespace_passed, filename_passed, clang_format_done])
+    for name, passed in plugins_passed:
+        if not passed:
+            print("[x] tidy: error at tidy.%s" % name)
+    return all([dirname_passed, whitespace_passed, filename_passed, clang_format_done] +
+               [ passed for _, passed in plugins_passed ])
 
-def check_clang_format_prereq(silent_if_ok):
-    if subprocess.call("which clang-format > /dev/null", shell=True) != 0:
+def check_clang_format_prereq(silent_if_ok, files=None):
+    # clang_format is not imported if none of the files is to be formatted
+    if files != None and not any([ should_visit.should_visit(f) for f in files ]):
+        print_stage(silent_if_ok, "tidy.clang_format: skipped - no file to format")
+        return False
+    if clang_format.find_binary() == None:
         print_stage(silent_if_ok, "tidy.clang_format: skipped - program 'clang-format' not installed")
         return False
     elif not os.path.isfile(".clang-format"):
@@ -58,49 +80,528 @@ def check_clang_format_prereq(silent_if_ok):
         return False
     return True
 
+_dispatcher = None # (key, tidy_utils.checkers.Dispatcher) - see dispatcher()
+
+"""
+@return tidy_utils.checkers.Dispatcher - of the built-in file checkers, then the plugins
+"""
+def dispatcher():
+    global _dispatcher
+    file_checkers = checkers.BUILTINS + checkers.plugins()
+    # built again only if a checker is registered, or the path filter is configured, since the last time
+    key = (tuple([ id(checker) for checker in file_checkers ]), id(should_visit.default_filter()))
+    if _dispatcher == None or _dispatcher[0] != key:
+        _dispatcher = (key, checkers.Dispatcher(file_checkers))
+    return _dispatcher[1]
+
+def _is_builtin(checker):
+    return checker in checkers.BUILTINS
+
+"""
+@args path: str - path to the file
+      silent_if_ok: bool - no printing if no error
+      use_cache: bool - skip the checks that the content is known to pass
+      blob: str or None - SHA-1 of the staged content to check instead of the work tree file
+      hunks: list of tidy_utils.git_utils.Hunk or None - check whitespace only on the lines they add
+      scanned: tidy_utils.scanner.ScannedFile or None - the file, if it is read already
+@return tuple or None - result of filename_match.check_file(), None if not interested
+        bool - whether the file passes tidy.whitespace
+        list of tidy_utils.diagnostics.Diagnostic - the problems found by tidy.whitespace
+        dict - key: name of a plugin checker interested in the file, value: list of the problems it found
+"""
+def check_content(path, silent_if_ok=False, use_cache=True, blob=None, hunks=None, scanned=None):
+    # route the file to the checkers interested in it; read the file once, and scan it once
+    # for the rules of all of them (with hunks, whitespace checks the lines they add instead of the file)
+    if blob == None and scanned == None and not os.path.isfile(path):
+        # staged, but deleted from the work tree since: nothing there to check (with --index, the blob is)
+        return None, True, [], {}
+    routed = dispatcher().route(path)
+    # a checker's module is imported only here, when a file is routed to it
+    with_filename_match = checkers.FILENAME_MATCH in routed
+    wanted = [ name for checker in routed if not (hunks != None and checker is checkers.WHITESPACE)
+               for name in checker.rule_names ]
+    if scanned == None:
+        scanned = scanner.ScannedFile(path, wanted, blob)
+    filename_res = None
+    if with_filename_match:
+        # when profiling, the shared scan is timed as part of the checker that asks first
+        with metrics.stage("filename_match"), metrics.file(path):
+            filename_res = filename_match.check_file(path, False, use_cache, scanned)
+    whitespace_found = []
+    if checkers.WHITESPACE not in routed: # as whitespace.check_file() would do, without importing it
+        print_stage(silent_if_ok, "\tskip %s" % path)
+        whitespace_passed = True
+    else:
+        with metrics.stage("whitespace"), metrics.file(path):
+            if hunks != None:
+                whitespace_passed = whitespace.check_hunks(path, hunks, silent_if_ok, False, whitespace_found)[0]
+            else:
+                whitespace_passed = whitespace.check_file(
+                    path, silent_if_ok, False, use_cache, scanned, whitespace_found)[0]
+    plugins_found = {}
+    for checker in routed:
+        if not _is_builtin(checker):
+            with metrics.stage(checker.name), metrics.file(path):
+                plugins_found[checker.name] = list(checker.diagnose(path, scanned, use_cache))
+    return filename_res, whitespace_passed, whitespace_found, plugins_found
+
+"""
+@args results: list of (str, dict) - path to each file, and the problems found by the plugin checkers
+                                     (see check_content())
+      silent_if_ok: bool - no printing if no error
+      label: str - where the plugin checkers are run, e.g. "on staged files"
+@return list of (str, bool) - name of each plugin checker, and whether the files pass
+        list of tidy_utils.diagnostics.Diagnostic - the problems found
+"""
+def report_plugins(results, silent_if_ok, label):
+    plugins_passed, found = [], []
+    for checker in checkers.plugins():
+        print_stage(silent_if_ok, "%-24s %s" % ("tidy.%s:" % checker.name, label))
+        passed = True
+        for path, plugins_found in results:
+            if checker.name not in plugins_found:
+                continue
+            problems = plugins_found[checker.name]
+            if silent_if_ok and len(problems) == 0:
+                continue
+            print("\tvisit %s" % path)
+            for d in problems:
+                print("\t- %s" % diagnostics.format_human(d))
+            passed = passed and len(problems) == 0
+            found += problems
+        plugins_passed.append((checker.name, passed))
+    return plugins_passed, found
+
+"""
+@args path: str - path to the file
+      result: dict - the watcher's result on the file's content, see _watch_check()
+      silent_if_ok: bool - no printing if no error
+@return the same as check_content(), and it prints the same
+"""
+def check_content_from_watcher(path, result, silent_if_ok=False):
+    filename_res = tuple(result["filename_match"]) if result["filename_match"] != None else None
+    problems = None
+    if result["whitespace"] != None:
+        problems = [ diagnostics.Diagnostic.from_dict(d) for d in result["whitespace"] ]
+    whitespace_passed = whitespace.report_found(path, problems, silent_if_ok)[0]
+    return filename_res, whitespace_passed, problems or [], {}
+
+def _report_filename(results):
+    # filename_match is not imported if no file is routed to it
+    return filename_match.report(results)[0] if len(results) > 0 else True
+
+def _filename_found(results):
+    return [ filename_match.to_diagnostic(path, res) for path, res in results if res[0] == False ]
+
+def _with_metrics(with_metrics, func, *args):
+    if not with_metrics:
+        return func(*args)
+    recorder = metrics.start()
+    try:
+        with metrics.stage("total"):
+            passed = func(*args)
+    finally:
+        metrics.stop()
+    return passed, recorder
+
+"""
+@args filename: str - path to the file
+      silent_if_ok: bool - no printing if no error
+      with_description: bool - print a short description first
+      use_cache: bool - skip the checks that the content is known to pass
+      from_index: bool - check the staged content, not the work tree file
+      with_metrics: bool - also return where the time went
+      found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
+@return bool - whether the file passes
+        tidy_utils.metrics.Metrics - only if with_metrics is True
+"""
 # export as library interface
-def run_file(filename, silent_if_ok=False, with_description=False):
+def run_file(filename, silent_if_ok=False, with_description=False, use_cache=True, from_index=False, with_metrics=False,
+             found=None):
+    return _with_metrics(with_metrics, _run_file, filename, silent_if_ok, with_description, use_cache, from_index,
+                         found if found != None else [])
+
+def _run_file(filename, silent_if_ok, with_description, use_cache, from_index, found):
     if with_description:
         print_decription([filename])
 
+    # clang-format goes first, as whitespace has to see the formatted content;
+    # then filename_match and whitespace share one read of the file
+    run_clang_format, prereq_output = parallel.call_captured(check_clang_format_prereq, silent_if_ok, [filename])
+    if run_clang_format:
+        with metrics.stage("clang_format"), metrics.file(filename):
+            clang_format_done, format_output = parallel.call_captured(
+                clang_format.format_file, filename=filename, silent_if_ok=silent_if_ok, use_cache=use_cache)
+    blob = git_utils.get_index_blobs([filename]).get(filename) if from_index else None
+    content_res, content_output = parallel.call_captured(check_content, filename, silent_if_ok, use_cache, blob)
+
     print_stage(silent_if_ok, "tidy.dirname_discipline: skipped") # as this is a file
     dirname_passed = True
     print_stage(silent_if_ok, "tidy.filename_match: running...")
-    filename_passed = filename_match.check_file(filename)
-    if check_clang_format_prereq(silent_if_ok) == True:
+    filename_results = [ (filename, content_res[0]) ] if content_res[0] != None else []
+    filename_passed = _report_filename(filename_results)
+    found += _filename_found(filename_results)
+    _replay([prereq_output])
+    if run_clang_format:
         print_stage(silent_if_ok, "tidy.clang_format: running...")
-        clang_format_done = clang_format.format_file(filename=filename, silent_if_ok=silent_if_ok)
+        _replay([format_output])
+        if not clang_format_done:
+            found.append(clang_format.to_diagnostic(filename))
     else:
         clang_format_done = True # assume success, as it's not essential
     print_stage(silent_if_ok, "tidy.whitespace: running...")
-    whitespace_passed = whitespace.check_file(filename=filename, silent_if_ok=silent_if_ok)[0]
+    _replay([content_output])
+    whitespace_passed = content_res[1]
+    found += content_res[2]
+    plugins_passed, plugins_found = report_plugins([ (filename, content_res[3]) ], silent_if_ok, "running...")
+    found += plugins_found
 
-    return check_each_status(dirname_passed, whitespace_passed, filename_passed, clang_format_done)
+    result_cache.prune()
+    return check_each_status(dirname_passed, whitespace_passed, filename_passed, clang_format_done, plugins_passed)
 
+# one unit of work is a (checker, path) pair, or (clang_format, batch of paths); the checker's printout is captured,
+# so that it can be replayed in a deterministic order after the pool is drained; when profiling, the unit's
+# metrics are recorded on their own (it may run in a worker process) and merged afterwards
+UNIT_FUNCTIONS = {
+    # dirname_discipline, on the RunContext
+    "dirname_discipline": lambda context, silent_if_ok, use_cache: _check_dirname(context, use_cache),
+    "clang_format": lambda batch, silent_if_ok, use_cache: clang_format.format_batch(batch, use_cache),
+    # clang_format, on (path, line ranges)
+    "clang_format_lines": lambda item, silent_if_ok, use_cache: clang_format.format_lines(item),
+    # filename_match and whitespace, on (path, blob SHA-1 or None, staged hunks or None)
+    "content": lambda item, silent_if_ok, use_cache: check_content(item[0], silent_if_ok, use_cache, item[1], item[2]),
+    # filename_match alone, before clang_format, on (path, blob SHA-1 or None) - only with fail_fast
+    "filename_match": lambda item, silent_if_ok, use_cache: _check_filename(item[0], item[1], use_cache),
+}
+def _check_dirname(context, incremental):
+    found = []
+    return dirname_discipline.check_cwd(context, incremental, found), found
+
+def _check_filename(path, blob, use_cache):
+    # from the work tree, only a small prefix of the file is read
+    scanned = scanner.ScannedFile(path, filename_match.RULE_NAMES, blob) if blob != None else None
+    with metrics.file(path):
+        return filename_match.check_file(path, False, use_cache, scanned)
+
+def _run_unit(unit):
+    checker, path, silent_if_ok, use_cache, profile = unit
+    if not profile:
+        return parallel.call_captured(UNIT_FUNCTIONS[checker], path, silent_if_ok, use_cache) + (None,)
+    outer = metrics.swap(metrics.Metrics())
+    try:
+        with metrics.stage(checker):
+            res = parallel.call_captured(UNIT_FUNCTIONS[checker], path, silent_if_ok, use_cache)
+    finally:
+        unit_metrics = metrics.swap(outer)
+    return res + (unit_metrics.snapshot(),)
+
+def _merge_metrics(results):
+    for res in results:
+        if res[2] != None:
+            metrics.active().merge(res[2])
+
+def _replay(outputs):
+    for output in outputs:
+        if len(output):
+            sys.stdout.write(output)
+
+"""
+@args silent_if_ok: bool - no printing if no error
+      with_description: bool - print a short description first
+      jobs: int - number of worker processes, 0 means one per CPU, 1 means run in this process
+      use_cache: bool - skip the checks that the contents are known to pass
+      context: tidy_utils.run_context.RunContext or None - staged changes, None to ask git
+      from_index: bool - check the staged contents (read with 'git cat-file --batch'), not the work tree
+      changed_lines_only: bool - clang-format and check whitespace only on the lines changed by the staged hunks
+      with_metrics: bool - also return where the time went
+      found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
+      fail_fast: bool - stop at the first checker that fails, and skip the rest (see FAIL_FAST_ORDER)
+@return bool - whether the repo passes
+        tidy_utils.metrics.Metrics - only if with_metrics is True
+"""
 # export as library interface
-def run_repo(silent_if_ok=False, with_description=False):
-    # write staged changed files to current working directory
-    git_utils.dump_staged_changed_files()
+def run_repo(silent_if_ok=False, with_description=False, jobs=1, use_cache=True, context=None, from_index=False,
+             changed_lines_only=False, with_metrics=False, found=None, fail_fast=False):
+    return _with_metrics(with_metrics, _run_repo, silent_if_ok, with_description, jobs, use_cache, context,
+                         from_index, changed_lines_only, fail_fast, found if found != None else [])
+
+def _run_repo(silent_if_ok, with_description, jobs, use_cache, context, from_index, changed_lines_only, fail_fast,
+              found):
+    profile = metrics.active() != None
+    if context == None:
+        with metrics.stage("git"):
+            context = run_context.RunContext.from_git()
+    files = context.created_or_modified_files()
 
     if with_description:
-        print_decription(git_utils.load_staged_created_or_modified_files())
+        print_decription(files)
+
+    with metrics.stage("clang_format.select"):
+        run_clang_format, prereq_output = parallel.call_captured(check_clang_format_prereq, silent_if_ok, files)
+        if run_clang_format:
+            format_files, select_output = parallel.call_captured(clang_format.select_files, files, silent_if_ok, use_cache)
+            skipped = [] # with changed_lines_only, the files with unstaged changes
+            if changed_lines_only:
+                (line_items, skipped), lines_output = parallel.call_captured(clang_format.make_line_items, format_files)
+                select_output += lines_output
+                # none is formatted then, as the others would not be restaged
+                format_units = [ ("clang_format_lines", item) for item in line_items if len(skipped) == 0 ]
+            else:
+                format_batches = clang_format.make_batches(format_files, parallel.resolve_jobs(jobs))
+                format_units = [ ("clang_format", batch) for batch in format_batches ]
+
+    # clang-format modifies files, so the content units (filename_match and whitespace, which
+    # share one read of each file) are scheduled after every unit in the first wave is done;
+    # with fail_fast, the checkers are run one at a time instead, and the first that fails stops
+    # the run (see FAIL_FAST_ORDER), so that clang-format is not run on a commit rejected already
+    first_wave = [ ("dirname_discipline", context, silent_if_ok, use_cache, profile) ]
+    if run_clang_format and not fail_fast:
+        first_wave += [ (checker, item, silent_if_ok, use_cache, profile) for checker, item in format_units ]
+    first_results = parallel.map_ordered(_run_unit, first_wave, jobs)
+    _merge_metrics(first_results)
+    dirname_res, clang_format_res = first_results[0], first_results[1:]
+    failed_at = "dirname_discipline" if fail_fast and not dirname_res[0][0] else None
+
+    early_filename_results = None # only with fail_fast: list of (str, tuple) - path, and result of check_file()
+    if fail_fast and failed_at == None:
+        blobs = context.staged_blobs() if from_index else {}
+        filename_files = [ f for f in files if checkers.FILENAME_MATCH in dispatcher().route(f) ]
+        filename_units = [ ("filename_match", (f, blobs.get(f)), silent_if_ok, use_cache, profile) for f in filename_files ]
+        results = parallel.map_until(_run_unit, filename_units, jobs, lambda res: res[0][0] == False)
+        _merge_metrics(results)
+        early_filename_results = [ (f, res[0]) for f, res in zip(filename_files, results) ]
+        if any([ res[0] == False for _, res in early_filename_results ]):
+            failed_at = "filename_match"
+    if run_clang_format and fail_fast and failed_at == None:
+        format_units = [ (checker, item, silent_if_ok, use_cache, profile) for checker, item in format_units ]
+        clang_format_res = parallel.map_until(_run_unit, format_units, jobs, lambda res: len(res[0][0]) > 0)
+        _merge_metrics(clang_format_res)
+
+    if run_clang_format:
+        failed = [ filename for res in clang_format_res for filename in res[0][0] ]
+        clang_format_done = len(failed) == 0 and len(skipped) == 0
+        changed = []
+        restage_output = ""
+        if clang_format_done and failed_at == None: # not if fail_fast stopped before clang-format
+            with metrics.stage("clang_format.restage"):
+                changed = clang_format.files_to_restage(files, context.staged_blobs())
+                if len(changed) > 0:
+                    clang_format_done, restage_output = parallel.call_captured(clang_format.restage, changed)
+        if len(changed) > 0:
+            if from_index: # the staged contents are formatted now
+                with metrics.stage("git"):
+                    context = run_context.RunContext.from_git()
+        if fail_fast and failed_at == None and not clang_format_done:
+            failed_at = "clang_format"
+
+    second_results = [] # (path, result) pairs, in file order
+    if failed_at == None:
+        blobs = context.staged_blobs() if from_index else {}
+        with metrics.stage("git"): # after restaging, as whitespace goes after clang-format
+            hunks = git_utils.get_staged_hunks() if changed_lines_only else None
+        warm = {} # key: path, value: the watcher's result on its staged content
+        if use_cache and not changed_lines_only and len(checkers.plugins()) == 0: # the watcher does not run plugins
+            with metrics.stage("watch"):
+                restaged = set(changed) if run_clang_format else set()
+                warm = _ask_watcher(dict([ (f, blob) for f, blob in context.staged_blobs().items() if f not in restaged ]))
+        second_wave = [ ("content", (f, blobs.get(f), hunks.get(f, []) if hunks != None else None),
+                         silent_if_ok, use_cache, profile) for f in files if f not in warm ]
+        if fail_fast:
+            computed = iter(parallel.map_until(_run_unit, second_wave, jobs, lambda res: not _content_passed(res[0])))
+        else:
+            computed = iter(parallel.map_ordered(_run_unit, second_wave, jobs))
+        for f in files:
+            res = parallel.call_captured(check_content_from_watcher, f, warm[f], silent_if_ok) + (None,) \
+                  if f in warm else next(computed, None)
+            if res == None: # stopped by fail_fast
+                break
+            second_results.append((f, res))
+            if fail_fast and not _content_passed(res[0]):
+                break
+        _merge_metrics([ res for _, res in second_results ])
 
     print_stage(silent_if_ok, "tidy.dirname_discipline: on all files")
-    dirname_passed = dirname_discipline.check_cwd()
-    print_stage(silent_if_ok, "tidy.filename_match:     on staged files")
-    filename_passed = filename_match.check_dir(".")[0]
-    if check_clang_format_prereq(silent_if_ok) == True:
+    _replay([dirname_res[1]])
+    dirname_passed = dirname_res[0][0]
+    found += dirname_res[0][1]
+    filename_passed = True
+    if _is_skipped("filename_match", failed_at):
+        print_stage(silent_if_ok, "tidy.filename_match:     skipped - tidy.%s failed" % failed_at)
+    else:
+        print_stage(silent_if_ok, "tidy.filename_match:     on staged files")
+        if early_filename_results == None:
+            early_filename_results = [ (f, res[0][0]) for f, res in second_results if res[0][0] != None ]
+        filename_passed = _report_filename(early_filename_results)
+        found += _filename_found(early_filename_results)
+    _replay([prereq_output])
+    if run_clang_format and _is_skipped("clang_format", failed_at):
+        print_stage(silent_if_ok, "tidy.clang_format:       skipped - tidy.%s failed" % failed_at)
+        clang_format_done = True # not run
+    elif run_clang_format:
         print_stage(silent_if_ok, "tidy.clang_format:       on staged files")
-        clang_format_done = clang_format.format_cwd(silent_if_ok=silent_if_ok)
+        _replay([select_output] + [ res[1] for res in clang_format_res ])
+        clang_format.print_failures(failed)
+        found += [ clang_format.to_diagnostic(filename) for filename in failed ]
+        found += [ clang_format.unstaged_to_diagnostic(filename) for filename in skipped ]
+        _replay([restage_output])
     else:
         clang_format_done = True # assume success, as it's not essential
-    print_stage(silent_if_ok, "tidy.whitespace:         on staged files")
-    whitespace_passed = whitespace.check(target=".", silent_if_ok=silent_if_ok)[0]
+    if _is_skipped("whitespace", failed_at):
+        label = "skipped - tidy.%s failed" % failed_at
+        print_stage(silent_if_ok, "tidy.whitespace:         %s" % label)
+    else:
+        label = "on staged files"
+        print_stage(silent_if_ok, "tidy.whitespace:         %s" % label)
+        _replay([ res[1] for _, res in second_results ])
+    whitespace_passed = all([ res[0][1] for _, res in second_results ])
+    found += [ d for _, res in second_results for d in res[0][2] ]
+    plugins_passed, plugins_found = report_plugins(
+        [ (f, res[0][3]) for f, res in second_results ], silent_if_ok, label)
+    found += plugins_found
+
+    result_cache.prune()
+    return check_each_status(dirname_passed, whitespace_passed, filename_passed, clang_format_done, plugins_passed)
+
+# with fail_fast, the order the checkers are run in: the cheap ones that do not depend on the formatting
+# first (filename_match reads only the head comment, which clang-format leaves alone), and whitespace
+# (with the plugins) last, as it has to see the formatted content
+FAIL_FAST_ORDER = [ "dirname_discipline", "filename_match", "clang_format", "whitespace" ]
+
+def _is_skipped(checker, failed_at):
+    return failed_at != None and FAIL_FAST_ORDER.index(failed_at) < FAIL_FAST_ORDER.index(checker)
+
+def _content_passed(content_res):
+    # content_res: returned by check_content()
+    filename_res, whitespace_passed, _, plugins_found = content_res
+    return (filename_res == None or filename_res[0] != False) and whitespace_passed and \
+           all([ len(problems) == 0 for problems in plugins_found.values() ])
+
+"""
+@args silent_if_ok: bool - no printing if no error
+      jobs: int - number of worker processes, 0 means one per CPU, 1 means run in this process
+      use_cache: bool - skip the checks that the contents are known to pass
+      with_metrics: bool - also return where the time went
+      found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
+@return bool - whether the repo passes
+        tidy_utils.metrics.Metrics - only if with_metrics is True
+"""
+# export as library interface
+def run_all_files(silent_if_ok=False, jobs=1, use_cache=True, with_metrics=False, found=None):
+    return _with_metrics(with_metrics, _run_all_files, silent_if_ok, jobs, use_cache, found if found != None else [])
+
+def _run_all_files(silent_if_ok, jobs, use_cache, found):
+    # for a full audit, e.g. in nightly CI: paths are streamed from the tree walker into
+    # the checkers, and each result is printed as soon as it is ready (in order)
+    print_stage(silent_if_ok, "tidy.dirname_discipline: on all files")
+    with metrics.stage("dirname_discipline"):
+        dirname_passed = dirname_discipline.check_cwd(incremental=False, found=found)
+    print_stage(silent_if_ok, "tidy.clang_format:       skipped - not run on all files, as it modifies files")
+    print_stage(silent_if_ok, "tidy.whitespace:         on all files")
+    # filename_match does not go by should_visit, so the excluded paths are walked too, for it only
+    path_filter = should_visit.default_filter()
+    all_paths = ( f for f in tree_walk.iter_files(".", prune=False)
+                  if not path_filter.is_excluded(f) or checkers.FILENAME_MATCH in dispatcher().route(f) )
+    paths, unit_paths = itertools.tee(all_paths)
+    profile = metrics.active() != None
+    units = ( ("content", (f, None, None), silent_if_ok, use_cache, profile) for f in unit_paths )
+    whitespace_passed, filename_errors, plugin_results = True, [], []
+    for path, res in zip(paths, parallel.imap_ordered(_run_unit, units, jobs)):
+        (filename_res, passed, whitespace_found, plugins_found), output = res[0], res[1]
+        _merge_metrics([res])
+        _replay([output])
+        whitespace_passed = whitespace_passed and passed
+        found += whitespace_found
+        if filename_res != None and filename_res[0] == False:
+            filename_errors.append((path, filename_res))
+        if any([ len(problems) > 0 for problems in plugins_found.values() ]): # only these are reported
+            plugin_results.append((path, plugins_found))
+    print_stage(silent_if_ok, "tidy.filename_match:     on all files")
+    filename_passed = _report_filename(filename_errors)
+    found += _filename_found(filename_errors)
+    plugins_passed, plugins_found = report_plugins(plugin_results, silent_if_ok, "on all files")
+    found += plugins_found
+
+    result_cache.prune()
+    return check_each_status(dirname_passed, whitespace_passed, filename_passed, True, plugins_passed)
+
+# the watcher's results, each on the content of a file it saw last (see watch())
+_warm = {} # key: path, value: (blob SHA-1 of the content, result - see _watch_check())
+_warm_lock = threading.Lock()
+
+def _watch_check(path, silent_if_ok, use_cache, with_clang_format):
+    if not os.path.isfile(path): # deleted, or moved away
+        with _warm_lock:
+            _warm.pop(path, None)
+        return
+    if with_clang_format and should_visit.should_visit(path):
+        clang_format.format_file(path, silent_if_ok, use_cache)
+    # read the content once: its blob SHA-1 tells run_repo() whether the result is on the staged content
+    scanned = scanner.ScannedFile(path)
+    try:
+        blob = scanned.blob_sha()
+    except OSError: # deleted meanwhile
+        return
+    filename_res, _, whitespace_found, _ = check_content(path, silent_if_ok, use_cache, scanned=scanned)
+    if filename_res != None and filename_res[0] == False:
+        filename_match.report([ (path, filename_res) ])
+    result = {
+        "filename_match": filename_res,
+        "whitespace": [ d.to_dict() for d in whitespace_found ] if should_visit.should_visit(path) else None,
+    }
+    with _warm_lock:
+        _warm[path] = (blob, result)
+
+def _serve_results(message):
+    # the request has the staged blob SHA-1s of the files (key: path); results on other contents are stale
+    results = {}
+    with _warm_lock:
+        for path, blob in message.get("results", {}).items():
+            entry = _warm.get(path)
+            if entry != None and entry[0] == blob:
+                results[path] = entry[1]
+    return { "results": results }
 
-    # remove dumped
-    git_utils.remove_dumped()
+def _ask_watcher(blobs):
+    if len(blobs) == 0 or not os.path.exists(WATCH_SOCKET): # no watcher, as usual
+        return {}
+    import tidy_utils.format_server as format_server
+    reply = format_server.request(WATCH_SOCKET, { "results": blobs }, timeout=WATCH_REPLY_TIMEOUT)
+    return reply["results"] if reply != None else {}
 
-    return check_each_status(dirname_passed, whitespace_passed, filename_passed, clang_format_done)
+"""
+Check files as they are saved, until interrupted, and keep the results in memory, so that
+run_repo() (e.g. the pre-commit hook) uses them instead of checking the files again.
+@args silent_if_ok: bool - no printing if no error
+      use_cache: bool - skip the checks that the contents are known to pass
+      with_clang_format: bool - also clang-format each changed file (it modifies files)
+      polling: bool - poll the files, even if inotify is available
+@return bool - False if a watcher is running already in this repository
+"""
+# export as library interface
+def watch(silent_if_ok=False, use_cache=True, with_clang_format=False, polling=False):
+    import tidy_utils.file_watcher as file_watcher
+    import tidy_utils.format_server as format_server
+    if format_server.request(WATCH_SOCKET, { "ping": True }, timeout=5) != None:
+        return False
+    with_clang_format = with_clang_format and check_clang_format_prereq(silent_if_ok)
+    watcher = file_watcher.make_watcher(".", polling)
+    print_stage(silent_if_ok, "tidy.watch: watching for changes (%s), Ctrl-C to stop" % watcher.method)
+
+    def check_changes():
+        # first the staged files, as the hook will ask for them
+        for path in run_context.RunContext.from_git().created_or_modified_files():
+            _watch_check(path, silent_if_ok, use_cache, with_clang_format)
+        for batch in file_watcher.iter_batches(watcher):
+            print_stage(silent_if_ok, "tidy.watch: %d changed file%s" % (len(batch), 's' if len(batch) > 1 else ''))
+            for path in batch:
+                _watch_check(path, silent_if_ok, use_cache, with_clang_format)
+            sys.stdout.flush()
+            result_cache.prune()
+    threading.Thread(target=check_changes, daemon=True).start()
+    try:
+        return format_server.serve(WATCH_SOCKET, _serve_results, idle_timeout=None)
+    finally:
+        watcher.close()
 
 def main():
     # could be used by Git's pre-commit
@@ -112,17 +613,95 @@ def main():
     parser.add_argument("-s", "--silent", action="store_true", help="no printout, unless errors are dectected")
     parser.add_argument("-w", "--with-description", action="store_true",
                         help="print a short description, overriding -s/--silent")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="run checkers on staged files with N worker processes, " +
+                             "0 means one per CPU (default: 1, i.e. serially)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="re-check files even if their contents are known to be clean")
+    parser.add_argument("-a", "--all-files", action="store_true",
+                        help="audit all files in the repository (tracked files, or all files if not a Git " +
+                             "repository) instead of staged files, e.g. for CI; clang-format is not run")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                        help="also check files matching GLOB (fnmatch-style, '*' matches '/' too) " +
+                             "with clang-format and whitespace, regardless of file type; repeatable")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="never check files matching GLOB; repeatable")
+    parser.add_argument("--plugin", action="append", default=[], metavar="MODULE",
+                        help="import MODULE (a module name, or a path to a .py file) that registers " +
+                             "in-house checkers with tidy_utils.checkers.register(); repeatable")
+    parser.add_argument("--index", action="store_true",
+                        help="check the staged contents in Git's index, instead of the files in the work tree " +
+                             "(clang-format still formats the work tree and restages)")
+    parser.add_argument("--fail-fast", action="store_true",
+                        help="on staged files, stop at the first checker that fails and skip the rest, cheap " +
+                             "checkers first, so that clang-format is not run on a commit rejected already")
+    parser.add_argument("--changed-lines-only", action="store_true",
+                        help="clang-format and check whitespace only on the lines changed by the staged hunks " +
+                             "(from 'git diff --cached -U0')")
+    parser.add_argument("--profile", action="store_true",
+                        help="print where the time went: per checker, and the slowest files")
+    parser.add_argument("--profile-json", metavar="PATH", help="write the profile to PATH as JSON")
+    parser.add_argument("--profile-trace", metavar="PATH",
+                        help="write the profile to PATH in the Trace Event Format (e.g. for chrome://tracing)")
+    parser.add_argument("--format", choices=["text"] + sorted(diagnostics.REPORTERS), default="text",
+                        help="'text' prints as the checkers go (default); the others print only the problems, " +
+                             "one per line ('human'), as JSON lines ('jsonl'), or as SARIF ('sarif')")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, and check files as they are saved; the results are kept in memory, " +
+                             "and used by later runs on the staged files (e.g. the pre-commit hook)")
+    parser.add_argument("--watch-clang-format", action="store_true",
+                        help="with --watch, also clang-format each saved file (it modifies files)")
+    parser.add_argument("--watch-poll", action="store_true",
+                        help="with --watch, poll the files' stats instead of using inotify")
     args = parser.parse_args()
+    if len(args.plugin) > 0:
+        try:
+            checkers.load_plugins(args.plugin)
+        except (ImportError, OSError) as e:
+            print("[Error] plugin not loaded: %s" % e)
+            return 1
+    if args.watch:
+        if not os.path.isdir(".git"):
+            print("[Error] directory .git is missing.")
+            print("        Either you are not at this project's root,")
+            print("        or this is not a Git repository.")
+            return 1
+        if not watch(args.silent, not args.no_cache, args.watch_clang_format, args.watch_poll):
+            print("[Error] a watcher is running already: %s" % WATCH_SOCKET)
+            return 1
+        return 0
+
+    with_metrics = args.profile or args.profile_json != None or args.profile_trace != None
+    found = []
+    if args.format != "text":
+        # the checkers' printout is replaced by the report of the problems found
+        printout = io.StringIO()
+        with contextlib.redirect_stdout(printout):
+            ret = _run(args, True, with_metrics, found)
+        if ret != 0 and len(found) == 0: # failed before any checker could tell, e.g. not at the repo root
+            sys.stderr.write(printout.getvalue())
+        diagnostics.REPORTERS[args.format](found, sys.stdout)
+        return ret
+    return _run(args, args.silent, with_metrics, found)
+
+def _run(args, silent, with_metrics, found):
+
+    if len(args.include) > 0 or len(args.exclude) > 0:
+        should_visit.configure(args.include, args.exclude)
 
     if args.target and os.path.isfile(args.target):
-        passed = run_file(args.target, args.silent, args.with_description)
+        res = run_file(args.target, silent, args.with_description, not args.no_cache, args.index, with_metrics, found)
+    elif not args.target and args.all_files:
+        res = run_all_files(silent, args.jobs, not args.no_cache, with_metrics, found)
     elif not args.target:
         if not os.path.isdir(".git"):
             print("[Error] directory .git is missing.")
             print("        Either you are not at this project's root,")
             print("        or this is not a Git repository.")
             return 1
-        passed = run_repo(args.silent, args.with_description)
+        res = run_repo(silent, args.with_description, args.jobs, not args.no_cache, from_index=args.index,
+                       changed_lines_only=args.changed_lines_only, with_metrics=with_metrics, found=found,
+                       fail_fast=args.fail_fast)
     else:
         if os.path.isdir(args.target):
             print("[Error] 'target' argument should be a file,")
@@ -132,6 +711,15 @@ def main():
             print("[Error] file not found: %s" % args.target)
         return 1
 
+    passed = res[0] if with_metrics else res
+    if with_metrics:
+        if args.profile:
+            # to stderr if stdout is for the report
+            print(res[1].summary(), file=sys.stdout if args.format == "text" else sys.stderr)
+        if args.profile_json:
+            res[1].write_json(args.profile_json)
+        if args.profile_trace:
+            res[1].write_trace(args.profile_trace)
     return 0 if passed else 1
 
 if __name__ == "__main__":
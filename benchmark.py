@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: benchmark.py
+# ---------------------------
+# Time the checkers on throwaway Git repositories with generated, staged changes,
+# and write the timings as JSON, so that they can be compared across versions.
+# If clang-format is not installed, a stub that formats nothing is put on PATH.
+
+import os, sys, io, json, time, random, shutil, tempfile, platform, subprocess, contextlib, statistics
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, THIS_DIR) # so that the checkers import as they do when run from here
+
+import all as all_checkers
+import clang_format
+import dirname_discipline
+import filename_match
+import whitespace
+
+RESULT_VERSION = 1
+
+# a stand-in for clang-format: it reports no replacements and changes nothing
+STUB_FORMATTER = """#!%s
+import sys
+if "--version" in sys.argv:
+    print("clang-format version 0.0.0 (benchmark stub)")
+    sys.exit(0)
+for arg in sys.argv[1:]:
+    if not arg.startswith("-"):
+        sys.stdout.write("<?xml version='1.0'?>\\n<replacements xml:space='preserve' incomplete_format='false'>\\n</replacements>\\n")
+"""
+
+# (directory, suffix, head comment format) of generated source files
+SOURCE_KINDS = [
+    ("include/%s", ".h", "// File: %s"),
+    ("src/%s", ".cc", "// File: %s"),
+    ("src/%s", ".js", "/*\n * File: %s\n */"),
+    ("unit-tests/%s", ".cc", "// File: %s"),
+    ("tools/%s", ".py", "# File: %s"),
+]
+
+def _write(path, content):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def _source(rng, filename, head_format, lines, violation_rate):
+    # each kind of violation is put in a file with a chance of violation_rate, at a random line
+    head = head_format % (filename if rng.random() >= violation_rate else "wrong_" + filename)
+    body = [ "int value_%d = %d; // some code of typical length" % (i, i) for i in range(lines) ]
+    if lines > 0 and rng.random() < violation_rate:
+        body[rng.randrange(lines)] += "  " # trailing whitespace
+    if lines > 0 and rng.random() < violation_rate:
+        i = rng.randrange(lines)
+        body[i] = "\t" + body[i]
+    return head + "\n" + "\n".join(body) + "\n"
+
+"""
+Generate a Git repository with a base commit, and changes staged on top of it: the layout
+and every source file, with its head comment only, are committed; then the bodies are staged.
+@args root: str - path to an empty directory
+      num_files: int - number of staged source files
+      lines: int - number of lines of each file
+      num_modules: int - number of modules (include/<module>, src/<module>, ...)
+      violation_rate: float - chance of each kind of violation in a file
+      seed: int - seed of the random generator, so that a repository can be generated again
+"""
+def generate_repo(root, num_files, lines, num_modules=8, violation_rate=0.05, seed=0):
+    rng = random.Random(seed)
+    modules = [ "module%d" % i for i in range(max(1, num_modules)) ]
+    for dirname in ["include", "src", "unit-tests"]:
+        _write(os.path.join(root, dirname, "README.md"), "# %s\n" % dirname)
+    for module in modules: # so that every module matches
+        _write(os.path.join(root, "include", module, "%s.h" % module), "// File: %s.h\n" % module)
+    _write(os.path.join(root, "xeno", "thirdparty", "LICENSE.txt"), "license\n")
+    _write(os.path.join(root, "xeno", "thirdparty", "include", "thirdparty", "lib.h"), "int lib();\t\n")
+    _write(os.path.join(root, "xeno", "thirdparty", "unit-tests", "lib_test.cc"), "int main() {}\n")
+    _write(os.path.join(root, ".clang-format"), "BasedOnStyle: LLVM\n")
+    sources = [] # (path, content to stage)
+    for i in range(num_files):
+        dir_format, suffix, head_format = SOURCE_KINDS[i % len(SOURCE_KINDS)]
+        filename = "file%d%s" % (i, suffix)
+        path = os.path.join(root, dir_format % modules[i % len(modules)], filename)
+        sources.append((path, _source(rng, filename, head_format, lines, violation_rate)))
+        _write(path, head_format % filename + "\n")
+    # committed, so that there is a HEAD for what goes by it, e.g. dirname_discipline's index
+    for command in [["git", "init", "-q"], ["git", "add", "-A"],
+                    ["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost",
+                     "commit", "-q", "--no-verify", "-m", "base"]]:
+        subprocess.check_call(command, cwd=root)
+    for path, content in sources:
+        _write(path, content)
+    subprocess.check_call(["git", "add", "-A"], cwd=root)
+
+def _stats(runs):
+    return { "runs": runs, "min": min(runs), "median": statistics.median(runs), "mean": statistics.mean(runs) }
+
+def _time(func, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            func()
+        runs.append(time.perf_counter() - start)
+    return _stats(runs)
+
+def _hook(jobs, use_cache):
+    command = [sys.executable, os.path.join(THIS_DIR, "all.py"), "-s", "-j", str(jobs)]
+    subprocess.call(command + ([] if use_cache else ["--no-cache"]),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# stages of all.py (see all.UNIT_FUNCTIONS) that work on staged files
+FILE_CHECK_STAGES = ["clang_format", "clang_format_lines", "content"]
+
+def _first_file_check(jobs, use_cache):
+    # the time from starting all.py, as Git does, to the start of its first check on a file,
+    # taken from the trace it writes; that is what startup (imports and setup) costs a commit
+    fd, trace_path = tempfile.mkstemp(prefix="tidy-benchmark-trace-")
+    os.close(fd)
+    try:
+        command = [sys.executable, os.path.join(THIS_DIR, "all.py"), "-s", "-j", str(jobs),
+                   "--profile-trace", trace_path]
+        start = time.time()
+        subprocess.call(command + ([] if use_cache else ["--no-cache"]),
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        end = time.time()
+        with open(trace_path) as f:
+            events = json.load(f)["traceEvents"]
+    finally:
+        os.remove(trace_path)
+    starts = [ event["ts"] / 1e6 for event in events if event["cat"] != "stage" or event["name"] in FILE_CHECK_STAGES ]
+    return (min(starts) if len(starts) > 0 else end) - start # no files checked: the whole run
+
+"""
+@args repeat: int - number of runs of each benchmark
+      jobs: int - number of worker processes, for those that take it
+      use_cache: bool - let the checkers use the result cache (warm after the first run)
+@return dict - key: benchmark name, value: dict of timings in seconds
+"""
+def run_benchmarks(repeat=3, jobs=1, use_cache=False):
+    benchmarks = [
+        ("whitespace.check", lambda: whitespace.check(".", True, False, use_cache)),
+        ("filename_match.check_dir", lambda: filename_match.check_dir(".", use_cache)),
+        ("dirname_discipline.check_cwd", lambda: dirname_discipline.check_cwd(incremental=False)),
+        ("dirname_discipline.check_cwd.incremental", lambda: dirname_discipline.check_cwd()),
+        # clang-format goes after the read-only checkers, as it changes files
+        ("clang_format.format_cwd", lambda: clang_format.format_cwd(True, jobs, use_cache)),
+        ("all.run_repo", lambda: all_checkers.run_repo(True, False, jobs, use_cache)),
+        ("hook", lambda: _hook(jobs, use_cache)), # all.py in a new process, as Git runs it
+    ]
+    res = dict([ (name, _time(func, repeat)) for name, func in benchmarks ])
+    res["hook.first_file_check"] = _stats([ _first_file_check(jobs, use_cache) for _ in range(repeat) ])
+    return res
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Time the checkers on generated Git repositories, and print the timings as JSON")
+    parser.add_argument("-n", "--files", type=int, action="append", metavar="N",
+                        help="number of staged files of a generated repository; repeatable (default: 100 and 1000)")
+    parser.add_argument("-l", "--lines", type=int, default=200, help="number of lines of each file (default: 200)")
+    parser.add_argument("--modules", type=int, default=8, help="number of modules (default: 8)")
+    parser.add_argument("--violation-rate", type=float, default=0.05,
+                        help="chance of each kind of violation in a file (default: 0.05)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of runs of each benchmark (default: 3)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N", help="number of worker processes (default: 1)")
+    parser.add_argument("--cache", action="store_true", help="let the checkers use the result cache")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated contents (default: 0)")
+    parser.add_argument("-o", "--output", metavar="PATH", help="write the JSON to PATH instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the generated repositories, and print their paths")
+    args = parser.parse_args()
+
+    if shutil.which("git") == None:
+        print("[Error] git is not found")
+        return 1
+
+    result = {
+        "version": RESULT_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": { "lines": args.lines, "modules": args.modules, "violation_rate": args.violation_rate,
+                        "repeat": args.repeat, "jobs": args.jobs, "cache": args.cache, "seed": args.seed },
+        "repositories": [],
+    }
+    old_cwd, old_path = os.getcwd(), os.environ.get("PATH", "")
+    workdir = tempfile.mkdtemp(prefix="tidy-benchmark-")
+    try:
+        if shutil.which(clang_format.FORMAT_UTIL) == None:
+            stub = os.path.join(workdir, "bin", clang_format.FORMAT_UTIL)
+            _write(stub, STUB_FORMATTER % sys.executable)
+            os.chmod(stub, 0o755)
+            os.environ["PATH"] = os.path.dirname(stub) + os.pathsep + old_path
+        result["formatter"] = subprocess.check_output([clang_format.FORMAT_UTIL, "--version"]).decode().strip()
+
+        for num_files in args.files or [100, 1000]:
+            root = os.path.join(workdir, "repo-%d" % num_files)
+            os.makedirs(root)
+            generate_repo(root, num_files, args.lines, args.modules, args.violation_rate, args.seed)
+            os.chdir(root)
+            result["repositories"].append({ "files": num_files,
+                                            "benchmarks": run_benchmarks(args.repeat, args.jobs, args.cache) })
+            os.chdir(old_cwd)
+            if args.keep:
+                sys.stderr.write("kept: %s\n" % root)
+    finally:
+        os.chdir(old_cwd)
+        os.environ["PATH"] = old_path
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,58 +7,434 @@
 # Formats staged modified files, according to project's .clang-format, and restage.
 # Basically does git-clang-format's work, but I'd like to keep dependency small.
 # NOTE it only runs on git-staged files, and it DOES modify files.
+# clang-format is asked for its replacements (--output-replacements-xml), which are
+# applied here, so that only the files it actually changes are written and restaged.
+# With '--changed-lines-only', only the lines of the staged hunks are formatted (with
+# --lines, like git-clang-format), one clang-format process per file.
+#
+# With '--serve', it keeps running as a format server for the checkout (see
+# tidy_utils/format_server.py), and later runs hand their batches to it. The server
+# keeps the config version and the formatted contents it has seen resident, so a
+# content formatted before is written back without starting clang-format. Without
+# a server, clang-format is run by this process.
+#
+# As all.py runs it on every commit, the modules only needed to format something (the
+# XML parser, the server's client) are imported when there is something to format.
 
-import os, sys, subprocess
+import os, sys, subprocess, hashlib, shutil, collections, threading
+import tidy_utils.diagnostics as diagnostics
 import tidy_utils.git_utils as git_utils
+import tidy_utils.run_context as run_context
 import tidy_utils.should_visit as should_visit
+import tidy_utils.parallel as parallel
+import tidy_utils.result_cache as result_cache
+import tidy_utils.metrics as metrics
 
 THIS_DIR = os.path.dirname(__file__)
 FORMAT_UTIL = "clang-format"
+REPLACEMENTS_OPTION = "--output-replacements-xml"
+UNSTAGED_MESSAGE = "it has unstaged changes, stage or stash them first"
+CACHE_VERSION = "1" # bump it when the way of invoking clang-format changes
+SERVER_SOCKET = os.path.join(".git", "tidy-clang-format.sock")
+SERVER_MEMO_SIZE = 1024 # number of formatted contents kept by the server
 
 def print_out(silent, content):
     if not silent:
         print(content)
 
+MAX_COMMAND_LENGTH = git_utils.MAX_COMMAND_LENGTH
+
+_binary = False # not looked up yet
+"""
+@args refresh: bool - look it up again, instead of using what was found before
+@return str or None - path to the clang-format binary, None if it is not installed
+"""
+def find_binary(refresh=False):
+    global _binary
+    if _binary == False or refresh:
+        _binary = shutil.which(FORMAT_UTIL)
+    return _binary
+
+_config_version = None
+"""
+@args refresh: bool - look at the config again, instead of using what was found before
+@return str - version of the formatting config: .clang-format and the clang-format binary
+"""
+def config_version(refresh=False):
+    global _config_version
+    if _config_version == None or refresh:
+        _style_files.clear()
+        parts = [CACHE_VERSION]
+        if os.path.isfile(".clang-format"):
+            with open(".clang-format", 'rb') as f:
+                parts.append(hashlib.sha1(f.read()).hexdigest())
+        binary = find_binary(refresh)
+        if binary != None: # identify the binary by its stat, cheaper than running 'clang-format --version'
+            st = os.stat(binary)
+            parts += [binary, str(st.st_size), str(st.st_mtime)]
+        _config_version = ":".join(parts)
+    return _config_version
+
+STYLE_FILE_NAMES = [".clang-format", "_clang-format"] # looked up by clang-format, in this order
+_style_files = {} # key: path to a directory ("" for the root), value: SHA-1 of the style file that applies in it, "" if none
+
+def _style_file_sha(dirpath):
+    sha = _style_files.get(dirpath)
+    if sha == None:
+        for name in STYLE_FILE_NAMES:
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    sha = hashlib.sha1(f.read()).hexdigest()
+                break
+        if sha == None:
+            sha = _style_file_sha(os.path.dirname(dirpath)) if dirpath != "" else ""
+        _style_files[dirpath] = sha
+    return sha
+
+"""
+@args filename: str - path to the file, related to repo root
+@return str - what decides how the file is formatted, beside its content and config_version():
+              its extension, which decides the language, and the nearest style file up its directories
+"""
+def style_of(filename):
+    return "%s:%s" % (os.path.splitext(filename)[1], _style_file_sha(os.path.dirname(filename)))
+
+def cache_key(filename):
+    return result_cache.key_of_file(filename, "clang_format", config_version(), style_of(filename))
+
+"""
+@args batch: list of str - paths to the files
+      use_cache: bool - remember the formatted contents as clean
+@return list of str - paths to the files that clang-format failed on
+        list of str - paths to the files that were changed
+"""
+def format_batch(batch, use_cache=True):
+    failed, changed = _format_batch(batch)
+    if use_cache:
+        failed_set = set(failed)
+        for filename in batch:
+            if filename not in failed_set:
+                result_cache.record(cache_key(filename))
+    return failed, changed
+
+def _format_batch(batch):
+    import tidy_utils.format_server as format_server
+    reply = format_server.request(SERVER_SOCKET, { "files": batch })
+    if reply != None and "changed" in reply:
+        failed, errors, changed = reply["failed"], reply["errors"], reply["changed"]
+    else: # no server is running
+        failed, errors, changed = _format_locally(batch)
+    sys.stderr.write(errors)
+    return failed, changed
+
+"""
+@args out: bytes - output of 'clang-format --output-replacements-xml' on one or more files
+@return list of list of (int, int, bytes) - for each file, in order, the replacements:
+                                            byte offset, byte length, and the new text
+"""
+def parse_replacements(out):
+    from xml.etree import ElementTree
+    # clang-format prints one XML document per file
+    documents = [ b"<?xml" + doc for doc in out.split(b"<?xml")[1:] ]
+    return [ [ (int(item.get("offset")), int(item.get("length")), (item.text or "").encode("utf-8"))
+               for item in ElementTree.fromstring(doc).iter("replacement") ]
+             for doc in documents ]
+
+"""
+@args data: bytes - the content
+      replacements: list of (int, int, bytes) - see parse_replacements()
+@return bytes - the content with the replacements applied
+"""
+def apply_replacements(data, replacements):
+    pieces, pos = [], 0
+    for offset, length, text in sorted(replacements, key=lambda item: item[0]):
+        pieces += [data[pos:offset], text]
+        pos = offset + length
+    pieces.append(data[pos:])
+    return b"".join(pieces)
+
+def _apply_to_file(filename, replacements):
+    if len(replacements) == 0:
+        return False
+    with open(filename, 'rb') as f:
+        data = f.read()
+    formatted = apply_replacements(data, replacements)
+    if formatted == data:
+        return False
+    with open(filename, 'wb') as f:
+        f.write(formatted)
+    return True
+
+"""
+@args batch: list of str - paths to the files
+      options: list of str - more options to clang-format
+@return list of str - paths to the files that clang-format failed on
+        str - clang-format's error message on them
+        list of str - paths to the files that were changed
+"""
+def _format_locally(batch, options=()):
+    from xml.etree import ElementTree
+    metrics.count("subprocesses")
+    try:
+        proc = subprocess.Popen([FORMAT_UTIL, REPLACEMENTS_OPTION] + list(options) + batch,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError: # not installed
+        return batch, "", []
+    out, err = proc.communicate()
+    if proc.returncode == 0:
+        try:
+            replacements = parse_replacements(out)
+        except ElementTree.ParseError:
+            replacements = None
+        if replacements != None and len(replacements) == len(batch):
+            return [], "", [ filename for filename, items in zip(batch, replacements)
+                             if _apply_to_file(filename, items) ]
+        err = ("unexpected output of %s %s\n" % (FORMAT_UTIL, REPLACEMENTS_OPTION)).encode()
+    if len(batch) == 1:
+        return batch, err.decode("utf-8", "replace"), []
+    # split the batch down until the bad file is found; nothing is written for a failed batch
+    half = len(batch) // 2
+    failed1, errors1, changed1 = _format_locally(batch[:half], options)
+    failed2, errors2, changed2 = _format_locally(batch[half:], options)
+    return failed1 + failed2, errors1 + errors2, changed1 + changed2
+
+"""
+@args hunks: list of tidy_utils.git_utils.Hunk
+@return list of (int, int) - 1-based inclusive line ranges, for clang-format's --lines
+"""
+def line_ranges(hunks):
+    # like git-clang-format, a pure deletion has the line around it formatted
+    return [ (hunk.start, hunk.start + max(hunk.count, 1) - 1) for hunk in hunks if hunk.start > 0 ]
+
+"""
+@args files: list of str - paths to the staged files
+@return list of (str, list of (int, int)) - each file that has staged changed lines, and their
+                                            line ranges (see line_ranges()), for format_lines()
+        list of str - paths to the files skipped, as they have unstaged changes
+"""
+def make_line_items(files):
+    # the ranges are of the staged content, and restaging adds the whole work tree file, so
+    # a file with unstaged changes is left alone, lest wrong lines are formatted or they are committed
+    hunks = git_utils.get_staged_hunks()
+    unstaged = set([ item.path for item in git_utils.get_unstaged_changed() ])
+    items = [ (filename, line_ranges(hunks.get(filename, []))) for filename in files ]
+    items = [ item for item in items if len(item[1]) > 0 ]
+    skipped = [ filename for filename, _ in items if filename in unstaged ]
+    for filename in skipped:
+        print_out(False, "\tskip  %s: %s" % (filename, UNSTAGED_MESSAGE))
+    return [ item for item in items if item[0] not in unstaged ], skipped
+
+"""
+@args item: (str, list of (int, int)) - path to the file, and the line ranges to format
+@return list of str - paths to the files that clang-format failed on
+        list of str - paths to the files that were changed
+"""
+def format_lines(item):
+    # the ranges differ from file to file, so one process per file; not sent to the
+    # format server, as its memo is of whole files
+    filename, ranges = item
+    failed, errors, changed = _format_locally([filename], [ "--lines=%d:%d" % r for r in ranges ])
+    sys.stderr.write(errors)
+    return failed, changed
+
+_server_memo = collections.OrderedDict() # key: (config version, style_of(), blob SHA-1 of a content), value: formatted content
+_server_memo_lock = threading.Lock()
+
+def _memo_get(key):
+    with _server_memo_lock:
+        if key in _server_memo:
+            _server_memo.move_to_end(key)
+        return _server_memo.get(key)
+
+def _memo_put(key, formatted):
+    with _server_memo_lock:
+        _server_memo[key] = formatted
+        _server_memo.move_to_end(key)
+        while len(_server_memo) > SERVER_MEMO_SIZE:
+            _server_memo.popitem(last=False)
+
+"""
+Handles a request to the format server, see main().
+@args message: dict - "files": list of str - paths to the files to format
+@return dict - "failed": list of str - paths to the files that clang-format failed on
+               "errors": str - clang-format's error message on them
+               "changed": list of str - paths to the files that were changed
+"""
+def serve_format(message):
+    version = config_version(refresh=True) # .clang-format might have changed since the last request
+    misses, changed = [], []
+    for filename in message["files"]:
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            misses.append((filename, None)) # let clang-format report it
+            continue
+        formatted = _memo_get((version, style_of(filename), result_cache.blob_sha(data)))
+        if formatted == None:
+            misses.append((filename, result_cache.blob_sha(data)))
+        elif formatted != data:
+            with open(filename, 'wb') as f:
+                f.write(formatted)
+            changed.append(filename)
+    if len(misses) == 0:
+        return { "failed": [], "errors": "", "changed": changed }
+    failed, errors, miss_changed = _format_locally([ filename for filename, _ in misses ])
+    failed_set = set(failed)
+    for filename, blob in misses:
+        if filename in failed_set or blob == None:
+            continue
+        with open(filename, 'rb') as f:
+            formatted = f.read()
+        style = style_of(filename)
+        _memo_put((version, style, blob), formatted)
+        _memo_put((version, style, result_cache.blob_sha(formatted)), formatted) # formatting is idempotent
+    changed_set = set(changed + miss_changed)
+    return { "failed": failed, "errors": errors,
+             "changed": [ filename for filename in message["files"] if filename in changed_set ] }
+
+"""
+@args files: list of str - paths to the files
+      jobs: int - number of batches that are going to run in parallel
+@return list of list of str - batches of paths, each fits in one command line
+"""
+def make_batches(files, jobs=1):
+    max_batch_size = max(1, -(-len(files) // max(1, jobs))) # ceiling, so every job gets a batch
+    base_length = len(" ".join([FORMAT_UTIL, REPLACEMENTS_OPTION])) # as in _format_locally()
+    batches, batch, length = [], [], base_length
+    for path in files:
+        if len(batch) > 0 and (len(batch) >= max_batch_size or length + 1 + len(path) > MAX_COMMAND_LENGTH):
+            batches.append(batch)
+            batch, length = [], base_length
+        batch.append(path)
+        length += 1 + len(path)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def _failure_message(filename):
+    # the command the file failed in, without the other files of its batch (and --lines ranges, if any)
+    return "error: %s %s %s" % (FORMAT_UTIL, REPLACEMENTS_OPTION, filename)
+
+def print_failures(failed):
+    for filename in failed:
+        print_out(False, "[Error] %s" % _failure_message(filename))
+    if len(failed) > 0:
+        print_out(False, "        did you installed clang-format?")
+        print_out(False, "        do you have .clang-format at project root?")
+
+"""
+@args filename: str - path to the file that failed to be formatted
+@return tidy_utils.diagnostics.Diagnostic - the problem
+"""
+def to_diagnostic(filename):
+    return diagnostics.Diagnostic("clang_format", filename, None, "clang_format.failed", _failure_message(filename))
+
+"""
+@args filename: str - path to the file skipped by make_line_items()
+@return tidy_utils.diagnostics.Diagnostic - the problem
+"""
+def unstaged_to_diagnostic(filename):
+    return diagnostics.Diagnostic("clang_format", filename, None, "clang_format.unstaged_changes", UNSTAGED_MESSAGE)
+
+"""
+@args files: list of str - paths to the files
+      silent_if_ok: bool - if True, do not print
+      use_cache: bool - leave out files whose contents are known to be formatted
+@return list of str - paths to the files that should be formatted
+"""
+def select_files(files, silent_if_ok=False, use_cache=True):
+    selected = []
+    for filename in files:
+        if not should_visit.should_visit(filename) or not os.path.isfile(filename): # e.g. deleted from the work tree
+            print_out(silent_if_ok, "\tskip  %s" % filename)
+            continue
+        print_out(silent_if_ok, "\tvisit %s" % filename)
+        metrics.count("files_visited")
+        if use_cache and result_cache.lookup(cache_key(filename)):
+            continue
+        selected.append(filename)
+    return selected
+
 """
 @args filename: str - the path to the file
       silent_if_ok: bool - if True, do not print
+      use_cache: bool - skip the file if its content is known to be formatted
 @return bool - if the utility returned successfully
 """
-def format_file(filename, silent_if_ok=False):
-    if not should_visit.should_visit(filename):
-        print_out(silent_if_ok, "\tskip  %s" % filename)
+def format_file(filename, silent_if_ok=False, use_cache=True):
+    if len(select_files([filename], silent_if_ok, use_cache)) == 0:
         return True # assume success
-    print_out(silent_if_ok, "\tvisit %s" % filename)
-    # -i: modify in-place
-    if 0 != subprocess.call(" ".join([FORMAT_UTIL, "-i", filename]), shell=True):
-        print_out(True, "[Error] error: %s -i %s" % (FORMAT_UTIL, filename))
-        print_out(True, "        did you installed clang-format?")
-        print_out(True, "        do you have .clang-format at project root?")
-        return False
-    return True
+    failed = format_batch([filename], use_cache)[0]
+    print_failures(failed)
+    return len(failed) == 0
 
 """
 @args silent_if_ok: bool - if True, do not print
+      jobs: int - number of clang-format processes to run in parallel, 0 means one per CPU
+      use_cache: bool - skip files whose contents are known to be formatted
+      context: tidy_utils.run_context.RunContext or None - staged changes, None to ask git
+      changed_lines_only: bool - format only the lines changed by the staged hunks
 @return bool - if the utility returned successfully
 """
-def format_cwd(silent_if_ok=False):
-    files = git_utils.load_staged_created_or_modified_files()
-    if files == None:
-        files = git_utils.get_staged_created_or_modified_files()
+def format_cwd(silent_if_ok=False, jobs=0, use_cache=True, context=None, changed_lines_only=False):
+    if context == None:
+        context = run_context.RunContext.from_git()
+    files = context.created_or_modified_files()
 
     if len(files) == 0:
         return True # assume success
 
-    for path in files:
-        if format_file(path, silent_if_ok) == False: # problem encountered
-            return False # immediately return, do not progress to the next file
-
-    # restage the visited files (some might be formatted; some are kept intact) and exit, but don't commit
-    if 0 == subprocess.call(" ".join(["git add"] + files), shell=True):
-        return True
+    selected = select_files(files, silent_if_ok, use_cache)
+    jobs = parallel.resolve_jobs(jobs)
+    if changed_lines_only:
+        # the files are not formatted as a whole, so they are not recorded in the cache
+        items, skipped = make_line_items(selected)
+        if len(skipped) > 0:
+            return False # do not format the others either, as they would not be restaged
+        batch_results = parallel.map_ordered(format_lines, items, jobs)
     else:
+        batches = make_batches(selected, jobs)
+        batch_results = parallel.map_ordered(format_batch if use_cache else _format_batch, batches, jobs)
+    failed = [ filename for res in batch_results for filename in res[0] ]
+    if len(failed) > 0: # problem encountered, do not restage
+        print_failures(failed)
+        return False
+
+    return restage(files_to_restage(files, context.staged_blobs()))
+
+"""
+@args files: list of str - paths to the staged files
+      staged_blobs: dict - key: path, value: SHA-1 of its content in the index
+@return list of str - paths to the files clang-format visits whose content in the work tree is
+                      not the staged one
+"""
+def files_to_restage(files, staged_blobs):
+    # not only the files changed by this run: a run that failed on one batch has written the
+    # others without restaging them, and the next run has nothing left to change in them
+    restaged = []
+    for filename in files:
+        if not should_visit.should_visit(filename) or not os.path.isfile(filename):
+            continue
+        try:
+            blob = result_cache.file_blob_sha(filename)
+        except (IOError, OSError):
+            continue
+        if blob != staged_blobs.get(filename):
+            restaged.append(filename)
+    return restaged
+
+"""
+@args files: list of str - paths to the files to restage, see files_to_restage()
+@return bool - if 'git add' returned successfully
+"""
+def restage(files):
+    # restage the formatted files (the others are kept intact, so not touched) and exit, but don't commit
+    if not git_utils.add(files):
         print("[Error] error at re-running 'git add' after formatting")
         return False
+    return True
 
 def main():
     import argparse
@@ -72,6 +448,16 @@ def main():
                "To format a single file, just use clang-format.",
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("-s", "--silent", action="store_true", help="no printing")
+    parser.add_argument("-j", "--jobs", type=int, default=0, metavar="N",
+                        help="run N clang-format processes in parallel,\n0 means one per CPU (default)")
+    parser.add_argument("--no-cache", action="store_true", help="re-format files even if they are known to be formatted")
+    parser.add_argument("--changed-lines-only", action="store_true",
+                        help="format only the lines changed by the staged hunks\n(from 'git diff --cached -U0')")
+    parser.add_argument("--serve", action="store_true",
+                        help="keep running as a format server for this repository,\n" +
+                             "which later runs hand their files to (Unix only)")
+    parser.add_argument("--idle-timeout", type=float, default=600, metavar="SEC",
+                        help="with --serve, exit after SEC seconds without requests\n(default: 600)")
     args = parser.parse_args()
 
     if not os.path.isdir(".git"):
@@ -79,7 +465,18 @@ def main():
         print("        Either you are not at this project's root,")
         print("        or this is not a Git repository.")
         return 1
-    successful = format_cwd()
+    if args.serve:
+        import tidy_utils.format_server as format_server
+        if not format_server.is_supported():
+            print("[Error] --serve needs Unix domain sockets, not available on this platform")
+            return 1
+        if not format_server.serve(SERVER_SOCKET, serve_format, args.idle_timeout):
+            print("[Error] a format server is running already: %s" % SERVER_SOCKET)
+            return 1
+        return 0
+    successful = format_cwd(args.silent, args.jobs, not args.no_cache, run_context.RunContext.for_cli(),
+                            args.changed_lines_only)
+    result_cache.prune()
     return 0 if successful else 1
 
 if __name__ == "__main__":
@@ -6,130 +6,309 @@
 # ---------------------------
 # Check directory name discipline of current working directory
 # NOTE it runs on all files, not just staged ones.
+#
+# The rules are checked against a model of the relevant directories: for each listed
+# directory, its entries and whether each is a directory. In a Git repository, the model
+# also counts the files under each directory, so that it knows when a directory that is
+# not listed itself (e.g. src/<module>/<sub>) becomes empty. The model
+# is of the commit HEAD is at (listed with 'git ls-tree', so untracked files are not in it),
+# with the staged changes. It is kept in INDEX_FILE between runs, for the commit HEAD was
+# at. A later run updates it with 'git diff' between the two commits and then with the
+# staged changes, so the work is proportional to the change. It is rebuilt if it is missing
+# or cannot be brought up to date.
+
+import os, sys, json
+import tidy_utils.diagnostics as diagnostics
+import tidy_utils.git_utils as git_utils
+import tidy_utils.result_cache as result_cache
+import tidy_utils.run_context as run_context
 
-import os, sys
+ROOT_DIRS = ["include", "src", "unit-tests", "tests", "xeno"]
+INDEX_FILE = os.path.join(result_cache.CACHE_DIR, "dirname-index.json")
+INDEX_VERSION = 2
 
 """
-@return: bool - whether the repo (current working directory) passed
+@args dirpath: str - path to a directory, related to repo root ("." for the root)
+@return bool - whether the model keeps the directory's listing
+"""
+def is_listed_dir(dirpath):
+    if dirpath == ".":
+        return True
+    parts = dirpath.split("/")
+    if len(parts) == 1:
+        return parts[0] in ROOT_DIRS
+    if len(parts) == 2: # include/<module>, src/<module>, xeno/<component>
+        return parts[0] in ("include", "src", "xeno")
+    if len(parts) == 3: # xeno/<component>/include
+        return parts[0] == "xeno" and parts[2] == "include"
+    return False
+
+def _join(dirpath, name):
+    return name if dirpath == "." else dirpath + "/" + name
+
+def _list_into(model, dirpath):
+    # os.scandir() gives each entry's type from the directory listing itself, so
+    # each listed directory costs one read, and no stat per entry
+    listing = {}
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            listing[entry.name] = entry.is_dir()
+    if dirpath == ".":
+        listing = dict([ (name, True) for name in ROOT_DIRS if listing.get(name) ])
+    model[dirpath] = listing
+    for name, is_dir in listing.items():
+        if is_dir and is_listed_dir(_join(dirpath, name)):
+            _list_into(model, _join(dirpath, name))
+
+"""
+@return dict - the model of current working directory: key: path to a listed directory,
+               value: dict (key: entry name, value: False for a file; for a directory, True,
+               or in a model of a commit, the number of files under it)
+"""
+def build_model():
+    # one pass over the listed directories; every rule is then checked on the model
+    model = {}
+    _list_into(model, ".")
+    return model
+
+"""
+@args commit: str - SHA-1 of a commit
+@return dict - the model of the commit's tree, see build_model()
+"""
+def build_model_of_commit(commit):
+    model = { ".": {} }
+    for path in git_utils.list_tree(commit, ROOT_DIRS):
+        add_path(model, path)
+    return model
+
+"""
+Record that a file is added; the model must not have it yet, as the directories
+on its path count it.
+@args path: str - path to the file, related to repo root
+"""
+def add_path(model, path):
+    parts = path.split("/")
+    for i in range(len(parts)):
+        parent, name, is_dir = "/".join(parts[:i]) or ".", parts[i], i < len(parts) - 1
+        if not is_listed_dir(parent) or (parent == "." and not (is_dir and name in ROOT_DIRS)):
+            return
+        listing = model.setdefault(parent, {})
+        listing[name] = listing.get(name, 0) + 1 if is_dir else False
+        if is_dir and is_listed_dir(_join(parent, name)):
+            model.setdefault(_join(parent, name), {})
+
+"""
+Record that a file is gone; it is harmless if the model does not have it.
+A directory that becomes empty is removed, as Git does.
+@args path: str - path to the file, related to repo root
+"""
+def remove_path(model, path):
+    parts = path.split("/")
+    for i in range(len(parts)):
+        parent, name, is_dir = "/".join(parts[:i]) or ".", parts[i], i < len(parts) - 1
+        listing = model.get(parent, {})
+        if name not in listing:
+            return
+        if is_dir and listing[name] > 1:
+            listing[name] -= 1
+            continue
+        del listing[name] # the file, or its last directory: what is under it is gone too
+        model.pop(_join(parent, name), None)
+        for dirpath in [ dirpath for dirpath in model if dirpath.startswith(_join(parent, name) + "/") ]:
+            del model[dirpath]
+        return
+
+"""
+@args model: dict - see build_model_of_commit()
+      changes: list of tidy_utils.git_utils.FileStatus - relative to the commit of the model
+"""
+def apply_changes(model, changes):
+    for item in changes:
+        if item.status == "R":
+            remove_path(model, item.old_path)
+        if item.status == "D":
+            remove_path(model, item.path)
+        elif item.status in ("A", "C", "R"):
+            add_path(model, item.path)
+        # else: the file is in the model already
+
+def _load_index():
+    try:
+        with open(INDEX_FILE, 'r') as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    return index if index.get("version") == INDEX_VERSION else None
+
+def _save_index(head, model):
+    if not os.path.isdir(result_cache.CACHE_DIR):
+        os.makedirs(result_cache.CACHE_DIR)
+    tmp = INDEX_FILE + ".%d.tmp" % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump({ "version": INDEX_VERSION, "head": head, "model": model }, f)
+    os.rename(tmp, INDEX_FILE) # atomic, so concurrent runs see either file whole
+
+"""
+@args context: tidy_utils.run_context.RunContext - staged changes
+      rebuild: bool - rebuild the index kept between runs, instead of updating it
+@return dict - the model of the repo at current working directory, with staged changes
 """
-def check_cwd():
-    include_exist = os.path.isdir("include")
-    src_exist = os.path.isdir("src")
-    unit_tests_exist = os.path.isdir("unit-tests")
-    tests_exist = os.path.isdir("tests") # can be missing
+def load_model(context, rebuild=False):
+    head = git_utils.get_head()
+    index = _load_index() if not rebuild else None
+    model = None
+    if head != None and index != None:
+        if index["head"] == head:
+            model = index["model"]
+        else:
+            changes = git_utils.get_changed_between(index["head"], head)
+            if changes != None:
+                model = index["model"]
+                apply_changes(model, changes)
+                _save_index(head, model)
+    if model == None: # missing or stale: rebuild
+        if head != None:
+            model = build_model_of_commit(head)
+            _save_index(head, model)
+        else: # no commit yet
+            model = { ".": {} }
+    apply_changes(model, context.staged) # not saved, they are not committed yet
+    return model
+
+"""
+@args context: tidy_utils.run_context.RunContext - staged changes
+@return list of str - the listed directories whose listing, as updated from the index kept
+                      between runs, differs from the one rebuilt from scratch (which is kept then)
+"""
+def verify_index(context):
+    updated = load_model(context)
+    rebuilt = load_model(context, rebuild=True)
+    return sorted([ dirpath for dirpath in set(updated) | set(rebuilt) if updated.get(dirpath) != rebuilt.get(dirpath) ])
+
+def _entries(model, dirpath):
+    return sorted(model.get(dirpath, {}).items())
+
+def _problem(path, code, message):
+    return diagnostics.Diagnostic("dirname_discipline", path, None, "dirname_discipline." + code, message)
+
+"""
+@args model: dict - see build_model()
+@return: iterator of tidy_utils.diagnostics.Diagnostic - the problems
+"""
+def diagnose_model(model):
+    root = model.get(".", {})
+    include_exist = root.get("include", False)
+    src_exist = root.get("src", False)
+    unit_tests_exist = root.get("unit-tests", False)
+    tests_exist = root.get("tests", False) # can be missing
 
     if not include_exist:
-        return True # this is not a C/C++ repo, then assume it passed
+        return # this is not a C/C++ repo, then assume it passed
 
     # now, include_exist == True
-    dir_missing = False
     if not src_exist:
-        print("[Error] not found: ./src")
-        dir_missing = True
+        yield _problem("src", "missing_dir", "not found: ./src")
     if not unit_tests_exist:
-        print("[Error] not found: ./unit-tests")
-        dir_missing = True
-    if dir_missing:
-        return False
-
-    has_error = False
+        yield _problem("unit-tests", "missing_dir", "not found: ./unit-tests")
+    if not (src_exist and unit_tests_exist):
+        return
 
-    include_readme_exist = os.path.isfile("include/README.md")
-    src_readme_exist = os.path.isfile("src/README.md")
-    unit_readme_tests_exist = os.path.isfile("unit-tests/README.md")
-    tests_readme_exist = os.path.isfile("tests/README.md")
-
-    if not include_readme_exist:
-        print("[Error] not found: ./include/README.md")
-        has_error = True
-    if not src_readme_exist:
-        print("[Error] not found: ./src/README.md")
-        has_error = True
-    if not unit_readme_tests_exist:
-        print("[Error] not found: ./unit-tests/README.md")
-        has_error = True
-    if tests_exist and not tests_readme_exist: # can be missing
-        print("[Error] not found: ./tests/README.md")
-        has_error = True
+    for dirname in ["include", "src", "unit-tests"] + (["tests"] if tests_exist else []): # tests can be missing
+        if model.get(dirname, {}).get("README.md") != False:
+            yield _problem(dirname, "missing_readme", "not found: ./%s/README.md" % dirname)
 
     modules = {} # key: name, value: number of files
-    for item in os.listdir("include"):
-        path = os.path.join("include", item)
-        if not os.path.isdir(path):
+    for item, is_dir in _entries(model, "include"):
+        if not is_dir:
             continue
-        path_ls = os.listdir(path)
-        for subitem in path_ls:
-            subpath = os.path.join(path, subitem)
-            if os.path.isdir(os.path.join(path, subitem)):
-                print("[Error] %s contains a directory %s" % (path, subitem))
-                has_error = True
-        modules[item] = len([subitem for subitem in path_ls if not subitem.startswith(".")])
+        path = _join("include", item)
+        for subitem, sub_is_dir in _entries(model, path):
+            if sub_is_dir:
+                yield _problem(path, "nested_dir", "%s contains a directory %s" % (path, subitem))
+        modules[item] = len([ subitem for subitem, _ in _entries(model, path) if not subitem.startswith(".") ])
 
     # xeno
-    if os.path.isdir("xeno"):
-        xeno_ls = os.listdir("xeno")
-        for item in xeno_ls:
-            path = os.path.join("xeno", item)
-            if not (os.path.isdir(path) and os.path.isfile(os.path.join(path, "LICENSE.txt"))):
-                continue
-            xeno_component_ls = os.listdir(path)
-            if "include" in xeno_component_ls:
-                has_unit_tests = "unit-tests" in xeno_component_ls
-                if not has_unit_tests:
-                    print("[Error] unit-tests expected to exist in %s" % path)
-                    has_error = True
-                for item2 in os.listdir(os.path.join(path, "include")):
-                    if os.path.isdir(os.path.join(path, "include", item2)):
-                        if item2 in modules:
-                            print("[Error] conflicting module name: %s" % item2)
-                        else:
-                            modules[item2] = None
-
-    for item in os.listdir("src"):
-        path = os.path.join("src", item)
-        if not os.path.isdir(path):
+    for item, is_dir in _entries(model, "xeno"):
+        path = _join("xeno", item)
+        component = model.get(path, {})
+        if not (is_dir and component.get("LICENSE.txt") == False):
             continue
-        has_error = False
-        path_ls = os.listdir(path)
-        for subitem in path_ls:
-            subpath = os.path.join(path, subitem)
-            if os.path.isdir(os.path.join(path, subitem)):
-                print("[Error] %s contains a directory %s" % (path, subitem))
-                has_error = True
-        if item not in modules:
-            print("[Error] src/%s has no match in include/" % path)
-            has_error = True
+        if "include" in component:
+            if "unit-tests" not in component:
+                yield _problem(path, "missing_dir", "unit-tests expected to exist in %s" % path)
+            for item2, is_dir2 in _entries(model, _join(path, "include")):
+                if is_dir2:
+                    if item2 in modules:
+                        yield _problem(_join(_join(path, "include"), item2), "conflicting_module",
+                                       "conflicting module name: %s" % item2)
+                    else:
+                        modules[item2] = None
 
-    for item in os.listdir("unit-tests"):
-        path = os.path.join("unit-tests", item)
-        if not os.path.isdir(path) or item == "build":
+    for item, is_dir in _entries(model, "src"):
+        if not is_dir:
             continue
-        has_error = False
+        path = _join("src", item)
+        for subitem, sub_is_dir in _entries(model, path):
+            if sub_is_dir:
+                yield _problem(path, "nested_dir", "%s contains a directory %s" % (path, subitem))
         if item not in modules:
-            print("[Error] unit-tests/%s has no match in include/" % path)
-            has_error = True
+            yield _problem(path, "unmatched_module", "%s has no match in include/" % path)
 
-    if tests_exist: # can be missing
-        for item in os.listdir("tests"):
-            path = os.path.join("unit-tests", item)
-            if not os.path.isdir(path) or item == "build":
+    for dirname in ["unit-tests"] + (["tests"] if tests_exist else []): # tests can be missing
+        for item, is_dir in _entries(model, dirname):
+            if not is_dir or item == "build":
                 continue
-            has_error = False
             if item not in modules:
-                print("[Error] unit-tests/%s has no match in include/" % path)
-                has_error = True
+                path = _join(dirname, item)
+                yield _problem(path, "unmatched_module", "%s has no match in include/" % path)
 
+"""
+@args model: dict - see build_model()
+      found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
+@return: bool - whether the model passed
+"""
+def check_model(model, found=None):
+    has_error = False
+    for d in diagnose_model(model):
+        print("[Error] %s" % d.message)
+        if found != None:
+            found.append(d)
+        has_error = True
     return True if not has_error else False
 
+"""
+@args context: tidy_utils.run_context.RunContext or None - staged changes, None to ask git
+      incremental: bool - update the index kept between runs, instead of rebuilding it (if in a Git repository)
+      found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
+@return: bool - whether the repo (current working directory) passed
+"""
+def check_cwd(context=None, incremental=True, found=None):
+    if os.path.isdir(".git"):
+        if context == None:
+            context = run_context.RunContext.from_git()
+        return check_model(load_model(context, rebuild=not incremental), found)
+    return check_model(build_model(), found)
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(
         description="Check directory name discipline of current working directory")
+    parser.add_argument("--full", action="store_true",
+                        help="rebuild the index kept in .git from scratch, instead of updating it")
+    parser.add_argument("--verify", action="store_true",
+                        help="check that updating the index kept in .git gives the same as rebuilding it")
     args = parser.parse_args()
 
     # check current working directory
-    success = check_cwd()
+    context = run_context.RunContext.for_cli() if os.path.isdir(".git") else None
+    if args.verify and context != None:
+        differ = verify_index(context)
+        for dirpath in differ:
+            print("[Error] the index kept in .git is out of date at: %s" % dirpath)
+        if len(differ) > 0:
+            return 1
+    success = check_cwd(context, incremental=not args.full)
     return 0 if success else 1
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
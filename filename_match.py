@@ -8,67 +8,133 @@
 # NOTE it only runs on git-staged files, and it does NOT modify files.
 
 import os, sys, re
-import tidy_utils.git_utils as git_utils
+import tidy_utils.checkers as checkers
+import tidy_utils.diagnostics as diagnostics
+import tidy_utils.metrics as metrics
+import tidy_utils.run_context as run_context
+import tidy_utils.result_cache as result_cache
+import tidy_utils.scanner as scanner
+import tidy_utils.tree_walk as tree_walk
 
-INTERESTED_FILENAME_SUFFIXES = [
-    ".cc", ".cpp", ".c", ".h",
-    ".py", ".sh", ".js",
-    ".json", ".yaml", ".yml", ".sch"
-]
+CACHE_VERSION = "1" # bump it when the rules change
+
+INTERESTED_FILENAME_SUFFIXES = list(checkers.FILENAME_MATCH_SUFFIXES)
 def is_interested(filename):
     for suffix in INTERESTED_FILENAME_SUFFIXES:
         if filename.endswith(suffix):
             return True
     return False
 
-FILENAME_LINE = re.compile(r'\A(#|\s?\*)\s?(F|f)ile:\s+(.+)')
+# matched on bytes, so that a file in any encoding is fine; only the file name is decoded
+FILENAME_LINE = re.compile(br'\A(#|\s?\*)\s?(F|f)ile:\s+(.+)')
+HEAD_COMMENT_LINES = 8
+
+# rule fed by tidy_utils.scanner, see RULE_NAMES
+class FilenameRule(scanner.Rule):
+    header_lines = HEAD_COMMENT_LINES
+
+    def __init__(self, path):
+        scanner.Rule.__init__(self, path)
+        self.result = (True, None, None, None)
+
+    def feed_header(self, lines):
+        filename = os.path.basename(self.path)
+        for i, line in enumerate(lines):
+            matchObj = FILENAME_LINE.match(line)
+            if matchObj:
+                comment_filename = matchObj.group(3).decode("utf-8", "replace")
+                if comment_filename != filename:
+                    self.result = (False, i + 1, comment_filename, filename)
+                    return
+
+scanner.register_rule("filename_match.head_comment", FilenameRule)
+RULE_NAMES = ["filename_match.head_comment"]
 
 """
 @args: filepath: str - the path to the file to be examined
        print_error: bool - if print error
+       use_cache: bool - skip the file if its content is known to be clean (only if scanned is given)
+       scanned: tidy_utils.scanner.ScannedFile or None - the file, if it is shared with other checkers
 @return: bool - whether the file is ok
          int or None - the line number of the comment line
          str or None - the comment filename
          str or None - the real filename
 """
-def check_file(filepath, print_error=True):
-    with open(filepath, 'r') as f:
-        first_lines = [ f.readline() for _ in range(8)]
-        for i, line in enumerate(first_lines):
-            matchObj = FILENAME_LINE.match(line)
-            if matchObj:
-                comment_filename = matchObj.group(3)
-                filename = os.path.basename(filepath)
-                if comment_filename != filename:
-                    res = (False, i + 1, comment_filename, filename)
-                    if print_error:
-                        print("[Error] %s line %d:" % (res[0], res[1]))
-                        print("     filename in intro is \x1b[38;5;196m%s\x1b[0;m" % res[2])
-                        print("     but should be \x1b[38;5;155m%s\x1b[0;m" % res[3])
-                    return res
-    return (True, None, None, None)
+def check_file(filepath, print_error=True, use_cache=True, scanned=None):
+    metrics.count("files_visited")
+    # on its own, the header (in a small prefix of the file) is cheaper to check than the whole
+    # content is to hash for the cache; if the file is shared, the others read all of it anyway
+    shared = scanned != None
+    if scanned == None:
+        if not os.path.isfile(filepath):
+            # file not found, assume it is because the file is deleted rather than created/modified
+            return (True, None, None, None)
+        scanned = scanner.ScannedFile(filepath)
+    # the result depends on the file name, not only the content
+    cache_key = None
+    if use_cache and shared and result_cache.is_available():
+        cache_key = result_cache.make_key(
+            scanned.blob_sha(), "filename_match", CACHE_VERSION, os.path.basename(filepath))
+    if result_cache.lookup(cache_key):
+        scanned.skip(RULE_NAMES)
+        return (True, None, None, None)
+    res = scanned.results(RULE_NAMES)["filename_match.head_comment"].result
+    if res[0] == False:
+        if print_error:
+            print("[Error] %s line %d:" % (res[0], res[1]))
+            print("     filename in intro is \x1b[38;5;196m%s\x1b[0;m" % res[2])
+            print("     but should be \x1b[38;5;155m%s\x1b[0;m" % res[3])
+        return res
+    result_cache.record(cache_key)
+    return res
 
 """
-@return: bool - whether the repo at current working directory is ok
-         int - number errors
+@args: filepath: str - the path to the file
+       res: tuple - the return value of check_file()
+@return: tidy_utils.diagnostics.Diagnostic or None - the problem, None if the file is ok
 """
-def check_dir(target):
+def to_diagnostic(filepath, res):
+    if res[0] != False:
+        return None
+    return diagnostics.Diagnostic("filename_match", filepath.replace("./", ""), res[1], "filename_match.head_comment",
+                                  "filename in intro is %s but should be %s" % (res[2], res[3]))
+
+"""
+@args: filepath: str - the path to the file to be examined
+       use_cache: bool - skip the file if its content is known to be clean
+       scanned: tidy_utils.scanner.ScannedFile or None - the file, if it is shared with other checkers
+@return: iterator of tidy_utils.diagnostics.Diagnostic - the problem, if any
+"""
+def diagnose_file(filepath, use_cache=True, scanned=None):
+    d = to_diagnostic(filepath, check_file(filepath, False, use_cache, scanned))
+    if d != None:
+        yield d
+
+"""
+@args: target: str - path to the directory
+       context: tidy_utils.run_context.RunContext or None - staged changes, None to ask git
+@return: list of str - paths to the files to be examined
+"""
+def collect_filepaths(target, context=None):
     filepaths = []
     if os.path.isdir(".git"): # .git is present
-        all_filepaths = git_utils.load_staged_created_or_modified_files()
-        if all_filepaths == None:
-            all_filepaths = git_utils.get_staged_created_or_modified_files()
+        if context == None:
+            context = run_context.RunContext.from_git()
+        all_filepaths = context.created_or_modified_files()
         filepaths = [ f for f in all_filepaths if is_interested(f) ]
     else: # .git is missing
-        for dirpath, _, filenames in os.walk(target):
-            for filename in filenames:
-                if not is_interested(filename):
-                    continue
-                filepaths.append(os.path.join(dirpath, filename))
+        # not pruned by should_visit, which filename_match does not go by
+        filepaths = [ f for f in tree_walk.walk_files(target, prune=False) if is_interested(f) ]
+    return filepaths
 
+"""
+@args: results: list of (str, tuple) - file path and the return value of check_file()
+@return: bool - whether all files are ok
+         int - number errors
+"""
+def report(results):
     error_count = 0
-    for filepath in filepaths:
-        res = check_file(filepath=filepath, print_error=False)
+    for filepath, res in results:
         if res[0] == False:
             error_count += 1
             print("[%02d] %s line %d:" % (error_count, filepath.replace("./", ""), res[1]))
@@ -80,6 +146,21 @@ def check_dir(target):
     else:
         return True, 0
 
+"""
+@args: target: str - path to the directory
+       use_cache: bool - skip files whose contents are known to be clean
+       context: tidy_utils.run_context.RunContext or None - staged changes, None to ask git
+       found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
+@return: bool - whether the repo at current working directory is ok
+         int - number errors
+"""
+def check_dir(target, use_cache=True, context=None, found=None):
+    filepaths = collect_filepaths(target, context)
+    results = [ (f, check_file(filepath=f, print_error=False, use_cache=use_cache)) for f in filepaths ]
+    if found != None:
+        found += [ to_diagnostic(f, res) for f, res in results if res[0] == False ]
+    return report(results)
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(
@@ -89,17 +170,20 @@ def main():
                "   if .git is present, visit each staged created/modified file",
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("target", nargs=1, help="path to directory or one file")
+    parser.add_argument("--no-cache", action="store_true", help="re-check files even if they are known to be clean")
     args = parser.parse_args()
 
     target = args.target[0]
     if os.path.isfile(target):
-        passed = check_file(target)[0]
+        passed = check_file(target, use_cache=not args.no_cache)[0]
     elif os.path.isdir(target):
-        passed = check_dir(target)
+        context = run_context.RunContext.for_cli() if os.path.isdir(".git") else None
+        passed = check_dir(target, use_cache=not args.no_cache, context=context)[0]
     else:
         print("[Error] not found: %s" % target)
         return 1
 
+    result_cache.prune()
     return 0 if passed else 1
 
 if __name__ == "__main__":
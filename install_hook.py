@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: install_hook.py
+# ---------------------------
+# Install all.py as the Git pre-commit hook of the repository at current working directory.
+#
+# The hook is a shell script. It asks Git whether anything is staged, with one
+# 'git diff-index --cached --quiet' (which compares the index with HEAD's tree, without
+# looking at the work tree), and exits at once if not, e.g. 'git commit --amend' to reword
+# a message; only otherwise it starts Python to run the checkers.
+
+import os, sys, stat, shlex
+import tidy_utils.git_utils as git_utils
+
+HOOK_NAME = "pre-commit"
+HOOK_MARKER = "# written by tidy's install_hook.py" # tells a hook it may overwrite
+DEFAULT_ARGS = ["--fail-fast"]
+
+HOOK_TEMPLATE = """#!/bin/sh
+%(marker)s, re-run it to update
+# nothing staged: nothing to check (if there is no HEAD yet, the diff fails, and all.py is run)
+git diff-index --cached --quiet HEAD -- 2>/dev/null && exit 0
+exec %(command)s
+"""
+
+"""
+@args python: str - path to the Python interpreter the hook runs all.py with
+      args: list of str - arguments to all.py
+@return str - content of the hook script
+"""
+def make_hook(python, args):
+    all_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "all.py")
+    command = " ".join([ shlex.quote(word) for word in [python, all_py] + args ])
+    return HOOK_TEMPLATE % { "marker": HOOK_MARKER, "command": command }
+
+"""
+@args python: str - path to the Python interpreter the hook runs all.py with
+      args: list of str - arguments to all.py
+      force: bool - overwrite a pre-commit hook not written by this script
+@return str or None - path to the hook written, None if there is another hook
+"""
+# export as library interface
+def install(python=sys.executable, args=DEFAULT_ARGS, force=False):
+    hooks_dir = git_utils.get_hooks_dir()
+    path = os.path.join(hooks_dir, HOOK_NAME)
+    if os.path.isfile(path) and not force:
+        with open(path, "r", errors="replace") as f:
+            if HOOK_MARKER not in f.read():
+                return None
+    os.makedirs(hooks_dir, exist_ok=True)
+    # write it next to the old one, which is replaced only when the new one is complete
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(make_hook(python, args))
+    os.chmod(temp_path, os.stat(temp_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.replace(temp_path, path)
+    return path
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Install all.py as the Git pre-commit hook of the repository at current working directory",
+        epilog="e.g. '%(prog)s -- -s -j 0' makes the hook run 'all.py -s -j 0'")
+    parser.add_argument("args", nargs="*", metavar="ARG",
+                        help="arguments to all.py in the hook, after '--' (default: %s)" % " ".join(DEFAULT_ARGS))
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="overwrite a pre-commit hook that is not written by this script")
+    parser.add_argument("--python", default=sys.executable, metavar="PATH",
+                        help="the Python interpreter the hook runs all.py with (default: %s)" % sys.executable)
+    args = parser.parse_args()
+
+    if not os.path.isdir(".git"):
+        print("[Error] directory .git is missing.")
+        print("        Either you are not at this project's root,")
+        print("        or this is not a Git repository.")
+        return 1
+    path = install(args.python, args.args if len(args.args) > 0 else DEFAULT_ARGS, args.force)
+    if path == None:
+        print("[Error] there is a pre-commit hook already, not written by this script,")
+        print("        use -f/--force to overwrite it")
+        return 1
+    print("installed: %s" % path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
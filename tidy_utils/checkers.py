@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: checkers.py
+# ---------------------------
+# File checkers as plugins: a checker declares the file types it is interested in, and
+# a Dispatcher routes each file only to the checkers interested in it, by an index from
+# file extensions to checkers built once, instead of offering every file to every checker.
+#
+# The built-in file checkers are declared here with their file types (see BUILTINS), so
+# that files are routed to them without importing their modules; a module is imported
+# when a file is first routed to it. In-house checkers are registered with register(),
+# by a module imported with load_plugins() (all.py's --plugin); the module names are kept
+# in the environment variable ENV_VAR, so that worker processes import them too.
+
+import os, sys, collections, importlib, importlib.util
+import tidy_utils.should_visit as should_visit
+
+ENV_VAR = "TIDY_PLUGINS"
+
+# the files that filename_match looks at
+FILENAME_MATCH_SUFFIXES = (
+    ".cc", ".cpp", ".c", ".h",
+    ".py", ".sh", ".js",
+    ".json", ".yaml", ".yml", ".sch"
+)
+
+# Base class of checkers. A checker overrides diagnose(), and sets suffixes, or overrides
+# interests() if they are decided at run time.
+class Checker(object):
+    name = None # str: unique, shown as "tidy.<name>"
+    suffixes = () # tuple of str: the file name suffixes of the files to check, e.g. ".cc"
+    rule_names = () # tuple of str: tidy_utils.scanner rules asked for, scanned in the same pass as the others'
+
+    """
+    @return tuple of str or None - the file name suffixes of the files to check, None for any file
+    """
+    def interests(self):
+        return self.suffixes
+
+    """
+    @args path: str - path to a file that has one of the suffixes, related to repo root
+    @return bool - whether the file is to be checked, e.g. False if it is in an excluded directory
+    """
+    def wants(self, path):
+        return True
+
+    """
+    @args path: str - path to the file, related to repo root
+          scanned: tidy_utils.scanner.ScannedFile - the file, read once for all checkers
+          use_cache: bool - skip the checks that the content is known to pass
+    @return iterator of tidy_utils.diagnostics.Diagnostic - the problems
+    """
+    def diagnose(self, path, scanned, use_cache=True):
+        return iter(())
+
+# A built-in checker: the module of the same name has RULE_NAMES and diagnose_file(), and
+# is imported only when they are used, i.e. when a file is routed to the checker.
+class Builtin(Checker):
+    """
+    @args name: str - name of the checker, and of its module
+          interests: callable - returns what Checker.interests() does
+          wants: callable or None - Checker.wants(), None if every file it is interested in is wanted
+    """
+    def __init__(self, name, interests, wants=None):
+        self.name = name
+        self._interests = interests
+        self._wants = wants
+
+    def interests(self):
+        return self._interests()
+
+    def wants(self, path):
+        return self._wants == None or self._wants(path)
+
+    def module(self):
+        return importlib.import_module(self.name)
+
+    @property
+    def rule_names(self):
+        return tuple(self.module().RULE_NAMES)
+
+    def diagnose(self, path, scanned, use_cache=True):
+        return self.module().diagnose_file(path, use_cache, scanned)
+
+def _whitespace_interests():
+    path_filter = should_visit.default_filter()
+    # with include globs, a file of any type might be visited
+    return None if len(path_filter.include_globs) > 0 else path_filter.suffixes
+
+FILENAME_MATCH = Builtin("filename_match", lambda: FILENAME_MATCH_SUFFIXES)
+WHITESPACE = Builtin("whitespace", _whitespace_interests, should_visit.should_visit)
+BUILTINS = [ FILENAME_MATCH, WHITESPACE ] # in the order their results are reported
+
+def _extension(name):
+    # the last extension of the base name, e.g. ".gz" of "a.tar.gz", "" of "Makefile"
+    base = os.path.basename(name)
+    dot = base.rfind(".")
+    return base[dot:] if dot >= 0 else ""
+
+class Dispatcher(object):
+    """
+    @args checkers: list of Checker - in the order their results are reported
+    """
+    def __init__(self, checkers):
+        self.checkers = list(checkers)
+        self._by_extension = {} # key: extension, value: list of (suffix, Checker)
+        self._any = [] # checkers interested in any file
+        for checker in self.checkers:
+            suffixes = checker.interests()
+            if suffixes == None:
+                self._any.append(checker)
+                continue
+            for suffix in suffixes:
+                self._by_extension.setdefault(_extension(suffix), []).append((suffix, checker))
+
+    """
+    @args path: str - path to the file, related to repo root
+    @return list of Checker - the checkers interested in the file, in the order of self.checkers
+    """
+    def route(self, path):
+        candidates = [ checker for suffix, checker in self._by_extension.get(_extension(path), [])
+                       if path.endswith(suffix) ] + self._any
+        chosen = set([ checker.name for checker in candidates if checker.wants(path) ])
+        return [ checker for checker in self.checkers if checker.name in chosen ]
+
+_registered = collections.OrderedDict() # key: name, value: Checker
+_loaded = None # names of the plugin modules imported, None if ENV_VAR is not looked at yet
+
+"""
+@args checker: Checker - to be run by all.py on the files it is interested in
+"""
+def register(checker):
+    if checker.name in _registered and _registered[checker.name] is not checker:
+        raise ValueError("checker already registered: %s" % checker.name)
+    _registered[checker.name] = checker
+
+def _import(name):
+    if name.endswith(".py"): # a path to the module's file
+        module_name = os.path.splitext(os.path.basename(name))[0]
+        if module_name in sys.modules:
+            return
+        spec = importlib.util.spec_from_file_location(module_name, name)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    else:
+        importlib.import_module(name)
+
+"""
+@args names: list of str - module names, or paths to the modules' files, that register checkers
+"""
+def load_plugins(names):
+    global _loaded
+    names = [ os.path.abspath(name) if name.endswith(".py") else name for name in names ]
+    os.environ[ENV_VAR] = os.pathsep.join(names)
+    _loaded = None
+    plugins()
+
+"""
+@return list of Checker - the registered checkers, after importing the plugin modules in ENV_VAR
+"""
+def plugins():
+    global _loaded
+    if _loaded == None:
+        _loaded = [ name for name in os.environ.get(ENV_VAR, "").split(os.pathsep) if name ]
+        for name in _loaded:
+            _import(name)
+    return list(_registered.values())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: diagnostics.py
+# ---------------------------
+# A problem found by a checker, as a record rather than printed text, and reporters
+# that render a list of them after the fact: one line per problem for humans, JSON
+# lines, or SARIF (for code scanning dashboards).
+
+import json
+
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+TOOL_NAME = "tidy"
+
+class Diagnostic(object):
+    __slots__ = ("checker", "path", "line", "code", "message")
+
+    """
+    @args checker: str - name of the checker, e.g. "whitespace"
+          path: str - path to the file or directory, related to repo root
+          line: int or None - 1-based line number, None if not about a line
+          code: str - identifies the kind of problem, e.g. "whitespace.tab"
+          message: str - what is wrong, for humans
+    """
+    def __init__(self, checker, path, line, code, message):
+        self.checker = checker
+        self.path = path
+        self.line = line
+        self.code = code
+        self.message = message
+
+    def to_dict(self):
+        return dict([ (name, getattr(self, name)) for name in self.__slots__ ])
+
+    """
+    @args d: dict - returned by to_dict(), e.g. sent from another process
+    @return Diagnostic
+    """
+    @staticmethod
+    def from_dict(d):
+        return Diagnostic(d["checker"], d["path"], d["line"], d["code"], d["message"])
+
+    def __repr__(self):
+        return "Diagnostic(%s)" % ", ".join([ repr(getattr(self, name)) for name in self.__slots__ ])
+
+    def __eq__(self, other):
+        return isinstance(other, Diagnostic) and self.to_dict() == other.to_dict()
+
+"""
+@args diagnostics: iterable of Diagnostic
+      out: text file object
+"""
+def write_human(diagnostics, out):
+    for d in diagnostics:
+        out.write(format_human(d) + "\n")
+
+"""
+@args d: Diagnostic
+@return str - one line: "path:line: message [code]"
+"""
+def format_human(d):
+    location = d.path if d.line == None else "%s:%d" % (d.path, d.line)
+    return "%s: %s [%s]" % (location, d.message, d.code)
+
+"""
+@args diagnostics: iterable of Diagnostic
+      out: text file object
+"""
+def write_jsonl(diagnostics, out):
+    for d in diagnostics:
+        out.write(json.dumps(d.to_dict(), sort_keys=True) + "\n")
+
+"""
+@args diagnostics: iterable of Diagnostic
+      out: text file object
+"""
+def write_sarif(diagnostics, out):
+    rules, results = {}, [] # rules: key: code, value: index
+    for d in diagnostics:
+        rules.setdefault(d.code, len(rules))
+        location = { "artifactLocation": { "uri": d.path } }
+        if d.line != None:
+            location["region"] = { "startLine": d.line }
+        results.append({ "ruleId": d.code, "ruleIndex": rules[d.code], "level": "error",
+                         "message": { "text": d.message }, "locations": [ { "physicalLocation": location } ] })
+    log = {
+        "$schema": SARIF_SCHEMA,
+        "version": "2.1.0",
+        "runs": [ {
+            "tool": { "driver": { "name": TOOL_NAME, "rules": [ { "id": code } for code in sorted(rules, key=rules.get) ] } },
+            "results": results,
+        } ],
+    }
+    json.dump(log, out, indent=2)
+    out.write("\n")
+
+# key: format name, value: reporter
+REPORTERS = {
+    "human": write_human,
+    "jsonl": write_jsonl,
+    "sarif": write_sarif,
+}
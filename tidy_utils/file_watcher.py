@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: file_watcher.py
+# ---------------------------
+# Tell which files under a directory change, as they change: with inotify (through
+# ctypes, so no dependency) on Linux, else by polling the files' stats. Directories
+# excluded by should_visit, and .git, are not watched.
+#
+# Editors write a file in several steps, so events are debounced and coalesced into
+# batches (see iter_batches()), and a file saved several times is in a batch once.
+
+import os, time, select, struct, ctypes, ctypes.util
+import tidy_utils.should_visit as should_visit
+import tidy_utils.tree_walk as tree_walk
+
+DEBOUNCE = 0.2 # seconds without events before a batch is done
+MAX_DELAY = 2.0 # seconds after the first event of a batch before it is done anyway
+POLL_INTERVAL = 1.0 # seconds
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len; followed by the name, len bytes
+READ_SIZE = 1 << 16
+
+def _join(dirpath, name):
+    return name if dirpath == "." else os.path.join(dirpath, name)
+
+class InotifyWatcher(object):
+    method = "inotify"
+
+    """
+    @args root: str - path to the directory to watch, with its subdirectories
+    @raise OSError - if inotify is not available, or there are too many directories to watch
+    """
+    def __init__(self, root="."):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"): # not Linux
+            raise OSError("inotify is not available")
+        self._root = root
+        self._filter = should_visit.default_filter()
+        self._dirs = {} # key: watch descriptor, value: path to the directory
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: %s" % os.strerror(ctypes.get_errno()))
+        try:
+            list(self._add_tree(root))
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _add_tree(self, top):
+        # watch top and the directories under it, and yield the files found in them: they might
+        # have been written before the directory is watched, e.g. in a directory moved in
+        stack = [top]
+        while len(stack) > 0:
+            dirpath = stack.pop()
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28: # ENOSPC: out of watches, see /proc/sys/fs/inotify/max_user_watches
+                    raise OSError(errno, "inotify_add_watch: %s" % os.strerror(errno))
+                continue # e.g. removed meanwhile
+            self._dirs[wd] = dirpath
+            try:
+                entries = list(os.scandir(dirpath))
+            except OSError:
+                continue
+            for entry in entries:
+                path = _join(dirpath, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".git" and not self._filter.is_excluded_dir(path):
+                        stack.append(path)
+                elif dirpath != top and not self._filter.is_excluded(path):
+                    yield path
+
+    """
+    @return int - number of directories watched
+    """
+    def size(self):
+        return len(self._dirs)
+
+    """
+    @args timeout: float or None - seconds to wait for a change, None to wait until there is one
+    @return set of str - paths to the files changed (created, written, moved or deleted), empty on timeout
+    """
+    def read(self, timeout=None):
+        if len(select.select([self._fd], [], [], timeout)[0]) == 0:
+            return set()
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return set()
+        changed, pos = set(), 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + EVENT_HEADER.size:pos + EVENT_HEADER.size + length].rstrip(b"\0"))
+            pos += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW: # events were dropped, so anything might have changed
+                changed.update(tree_walk.walk_files(self._root))
+                continue
+            dirpath = self._dirs.get(wd)
+            if dirpath == None:
+                continue
+            if mask & IN_IGNORED: # the directory is gone
+                del self._dirs[wd]
+                continue
+            path = _join(dirpath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and name != ".git" and not self._filter.is_excluded_dir(path):
+                    changed.update(self._add_tree(path))
+            elif not self._filter.is_excluded(path):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+class PollingWatcher(object):
+    method = "polling"
+
+    """
+    @args root: str - path to the directory to watch, with its subdirectories
+          interval: float - seconds between two looks at the files
+    """
+    def __init__(self, root=".", interval=POLL_INTERVAL):
+        self._root = root
+        self._interval = interval
+        self._stats = self._scan()
+
+    def _scan(self):
+        stats = {} # key: path, value: (mtime, size), which change when the file is written
+        for path in tree_walk.walk_files(self._root):
+            try:
+                st = os.stat(path)
+            except OSError: # removed meanwhile
+                continue
+            stats[path] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    """
+    @return int - number of files watched
+    """
+    def size(self):
+        return len(self._stats)
+
+    """
+    @args timeout: float or None - seconds to wait for a change, None to wait until there is one
+    @return set of str - paths to the files changed (created, written, moved or deleted), empty on timeout
+    """
+    def read(self, timeout=None):
+        deadline = None if timeout == None else time.monotonic() + timeout
+        while True:
+            time.sleep(self._interval if deadline == None else max(0, min(self._interval, deadline - time.monotonic())))
+            stats = self._scan()
+            changed = set([ path for path, stat in stats.items() if self._stats.get(path) != stat ])
+            changed.update([ path for path in self._stats if path not in stats ])
+            self._stats = stats
+            if len(changed) > 0 or (deadline != None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+"""
+@args root: str - path to the directory to watch, with its subdirectories
+      polling: bool - poll even if inotify is available
+@return InotifyWatcher or PollingWatcher - the former if possible
+"""
+def make_watcher(root=".", polling=False):
+    if not polling:
+        try:
+            return InotifyWatcher(root)
+        except OSError:
+            pass
+    return PollingWatcher(root)
+
+"""
+@args watcher: InotifyWatcher or PollingWatcher
+      debounce: float - seconds without events before a batch is done
+      max_delay: float - seconds after the first event of a batch before it is done anyway
+@return iterator of list of str - paths to the changed files, sorted, a batch at a time
+"""
+def iter_batches(watcher, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+    while True:
+        batch = watcher.read()
+        if len(batch) == 0:
+            continue
+        first = time.monotonic()
+        while True:
+            remaining = max_delay - (time.monotonic() - first)
+            if remaining <= 0:
+                break
+            more = watcher.read(min(debounce, remaining))
+            if len(more) == 0:
+                break
+            batch.update(more)
+        yield sorted(batch)
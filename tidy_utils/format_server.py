@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: format_server.py
+# ---------------------------
+# A small local server on a Unix domain socket, so that a checker can keep state
+# resident between runs in the same checkout. Each connection carries one request
+# and one reply, each a line of JSON.
+# Only works in repo root, not other directories: socket paths are relative to it.
+
+import os, json, socket, socketserver
+
+PROTOCOL_VERSION = 1
+
+"""
+@return bool - whether Unix domain sockets are available on this platform
+"""
+def is_supported():
+    return hasattr(socket, "AF_UNIX")
+
+"""
+@args path: str - path to the socket
+      message: dict - the request, serializable to JSON
+      timeout: float or None - seconds to wait for the reply, None to wait forever
+@return dict or None - the reply, or None if no server is listening or it failed to reply
+"""
+def request(path, message, timeout=None):
+    if not is_supported() or not os.path.exists(path):
+        return None
+    message = dict(message, protocol=PROTOCOL_VERSION)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(message).encode('utf-8') + b"\n")
+            with sock.makefile('rb') as f:
+                reply = json.loads(f.readline().decode('utf-8'))
+    except (OSError, ValueError): # not listening, e.g. a stale socket file, or cut off
+        return None
+    if not isinstance(reply, dict) or reply.get("protocol") != PROTOCOL_VERSION or "error" in reply:
+        return None
+    return reply
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+        if not isinstance(message, dict) or message.get("protocol") != PROTOCOL_VERSION:
+            reply = { "error": "unsupported protocol" }
+        elif message.get("ping"):
+            reply = {}
+        else:
+            try:
+                reply = self.server.handler(message)
+            except Exception as e: # keep serving; the client falls back to doing the work itself
+                reply = { "error": "%s: %s" % (type(e).__name__, e) }
+        reply["protocol"] = PROTOCOL_VERSION
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b"\n")
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    idle = False
+
+    def handle_timeout(self):
+        self.idle = True
+
+"""
+Serve requests until no request comes for idle_timeout seconds, or interrupted.
+@args path: str - path to the socket
+      handler: callable - takes a request (dict), returns the reply (dict); it may be
+               called by several threads at the same time
+      idle_timeout: float or None - seconds, None to serve until interrupted
+@return bool - False if another server is listening on path already
+"""
+def serve(path, handler, idle_timeout=600):
+    if request(path, { "ping": True }, timeout=5) != None:
+        return False
+    if os.path.exists(path):
+        os.remove(path) # left by a server that did not exit cleanly
+    server = _Server(path, _Handler)
+    server.handler = handler
+    server.timeout = idle_timeout
+    try:
+        while not server.idle:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+    return True
@@ -5,87 +5,290 @@
 # ---------------------------
 # My Git utilities. Only works in repo root, not other directories.
 
-import subprocess, os
+import subprocess, collections, atexit, re, codecs
+import tidy_utils.metrics as metrics
 
-# it decorates paths in the input list: passthrough if the file exists, prepend "- " if not.
-def _decorate_files(file_list):
-    return [ (f if os.path.exists(f) else "- %s" % f) for f in file_list ]
+# one changed file reported by 'git diff --raw'
+#   status: str - one letter, 'A' (added), 'C' (copied), 'D' (deleted), 'M' (modified),
+#                 'R' (renamed), 'T' (type changed), 'U' (unmerged), 'X' (unknown)
+#   path: str - path related to repo root
+#   old_path: str or None - the path before, if status is 'R' or 'C'
+#   blob: str or None - SHA-1 of the content in the index, None if deleted or not staged
+FileStatus = collections.namedtuple("FileStatus", ["status", "path", "old_path", "blob"])
 
-def _get_created_or_modified_from_decorated(decorated_files):
-    return [ item for item in decorated_files if not item.startswith("- ") ]
+CREATED_OR_MODIFIED = ("A", "C", "M", "R", "T")
+NULL_SHA = "0" * 40
 
-def _get_deleted_from_decorated(list):
-    return [ item for item in changed if item.startswith("- ") ]
+"""
+@args out: bytes - output of 'git diff --raw -z --no-abbrev'
+@return list of FileStatus
+"""
+def parse_raw(out):
+    fields = out.decode('utf-8', 'surrogateescape').split('\0')
+    records, i = [], 0
+    while i < len(fields) and fields[i].startswith(":"):
+        # ":<old mode> <new mode> <old sha> <new sha> <status>", then the path(s)
+        meta = fields[i][1:].split(" ")
+        status = meta[4][0] # the rest is the similarity score of 'R' and 'C'
+        blob = meta[3] if meta[3] != NULL_SHA else None
+        if status in ("R", "C"):
+            records.append(FileStatus(status, fields[i + 2], fields[i + 1], blob))
+            i += 3
+        else:
+            records.append(FileStatus(status, fields[i + 1], None, blob))
+            i += 2
+    return records
+
+"""
+@args records: list of FileStatus
+@return bytes - in the format of 'git diff --raw -z --no-abbrev', see parse_raw(); modes
+                and old SHA-1s are not kept by FileStatus, so they are filled with zeros
+"""
+def format_raw(records):
+    fields = []
+    for item in records:
+        fields.append(":000000 000000 %s %s %s" % (NULL_SHA, item.blob or NULL_SHA, item.status))
+        fields += [item.old_path, item.path] if item.old_path != None else [item.path]
+    return "".join([ field + "\0" for field in fields ]).encode('utf-8', 'surrogateescape')
+
+RAW_DIFF_COMMAND = ["git", "diff", "--raw", "-z", "--no-abbrev", "-M"]
+def _raw_diff(staged):
+    # -M: report renames with the old path (also the default, unless diff.renames=false)
+    metrics.count("subprocesses")
+    return subprocess.check_output(RAW_DIFF_COMMAND + (["--cached"] if staged else []))
+
+def _get_created_or_modified(records):
+    return [ item.path for item in records if item.status in CREATED_OR_MODIFIED ]
+
+def _get_deleted(records):
+    return [ item.path for item in records if item.status == "D" ]
 
 # get changed files (unstaged + staged)
 # NOTE untracked files (i.e. ignored by .gitignore) are not reported
 """
-@return list of str - paths, related to repo root (if is deleted files, prefix with "- ")
+@return list of FileStatus - sorted by path; if a file is both staged and modified
+                             in the work tree, the work tree's deletion wins
 """
 def get_all_changed():
-    COMMAND_STR = "{ git diff --name-only ; git diff --name-only --staged ; } | sort | uniq"
-    out = subprocess.check_output(COMMAND_STR, shell=True).decode('utf-8')
-    file_list = out.strip().split('\n') if len(out) != 0 else [] # paths are related to repo root
-    return _decorate_files(file_list)
+    records = dict([ (item.path, item) for item in parse_raw(_raw_diff(staged=True)) ])
+    for item in parse_raw(_raw_diff(staged=False)):
+        if item.path not in records or item.status == "D":
+            records[item.path] = item
+    return [ records[path] for path in sorted(records) ]
 
 # get changed files (staged only)
 # NOTE untracked files (i.e. ignored by .gitignore) are not reported
 """
-@return list of str - paths, related to repo root (if is deleted files, prefix with "- ")
+@return list of FileStatus - sorted by path
 """
 def get_staged_changed():
-    COMMAND_STR = "{ git diff --name-only --staged ; } | sort | uniq"
-    out = subprocess.check_output(COMMAND_STR, shell=True).decode('utf-8')
-    file_list = out.strip().split('\n') if len(out) != 0 else [] # paths are related to repo root
-    return _decorate_files(file_list)
+    return sorted(parse_raw(_raw_diff(staged=True)), key=lambda item: item.path)
+
+# get changed files (unstaged only)
+"""
+@return list of FileStatus - sorted by path; blobs are None, as the contents are in the work tree
+"""
+def get_unstaged_changed():
+    return sorted(parse_raw(_raw_diff(staged=False)), key=lambda item: item.path)
 
 """
-@return list of str - paths, related to repo root (if is deleted files, prefix with "- ")
+@return list of str - paths, related to repo root
 """
 def get_staged_created_or_modified_files():
-    decorated_files = get_staged_changed()
-    return _get_created_or_modified_from_decorated(decorated_files)
+    return _get_created_or_modified(get_staged_changed())
 
 """
-@return list of str - paths, related to repo root (if is deleted files, prefix with "- ")
+@return list of str - paths, related to repo root
 """
 def get_staged_deleted_files():
-    decorated_files = get_staged_changed()
-    return _get_deleted_from_decorated(decorated_files)
+    return _get_deleted(get_staged_changed())
 
-FILE_LIST_DUMP = "git-status.log"
-def dump_staged_changed_files():
-    # collect git-staged files that are created/modified, but not deleted, reported by 'git status'
-    decorated_files = get_staged_changed()
-    with open(FILE_LIST_DUMP, 'w') as dump: # overwrite if exists
-        dump.write("# git-staged files only\n")
-        dump.write("\n".join(decorated_files))
+# a conservative bound on the length of one command line, well below ARG_MAX on
+# Linux and macOS, and also below the 32K limit of CreateProcess on Windows
+MAX_COMMAND_LENGTH = 32000
 
-def _load_from_log(filename):
-    with open(filename, 'r') as dump:
-        lines = dump.read().split('\n')
-    return [ item for item in lines if (len(item) > 0 and not item.startswith("# "))]
+"""
+Stage the files, with as few 'git add' as the command line length allows.
+@args files: list of str - paths, related to repo root
+@return bool - if 'git add' returned successfully
+"""
+def add(files):
+    # no shell, so paths with spaces or quotes are fine
+    command = ["git", "add", "--"]
+    base_length = len(" ".join(command))
+    batch, length = [], base_length
+    for path in files + [None]: # None: the end
+        if len(batch) > 0 and (path == None or length + 1 + len(path) > MAX_COMMAND_LENGTH):
+            metrics.count("subprocesses")
+            if 0 != subprocess.call(command + batch):
+                return False
+            batch, length = [], base_length
+        if path != None:
+            batch.append(path)
+            length += 1 + len(path)
+    return True
 
 """
-return None (if FILE_LIST_DUMP not found)
-       list of str - paths, related to repo root (if FILE_LIST_DUMP is present)
+@return str or None - SHA-1 of the commit HEAD is at, None if there is no commit yet
 """
-def load_staged_created_or_modified_files():
-    if not os.path.isfile(FILE_LIST_DUMP):
+def get_head():
+    metrics.count("subprocesses")
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "-q", "--verify", "HEAD^{commit}"],
+                                      stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
         return None
-    decorated_files = _load_from_log(FILE_LIST_DUMP)
-    return _get_created_or_modified_from_decorated(decorated_files)
+    return out.decode("ascii").strip()
+
+"""
+@return str - path to the directory of the hooks (core.hooksPath, if set), related to current working directory
+"""
+def get_hooks_dir():
+    metrics.count("subprocesses")
+    out = subprocess.check_output(["git", "rev-parse", "--git-path", "hooks"])
+    return out.decode("utf-8").rstrip("\n")
 
 """
-return None (if FILE_LIST_DUMP not found)
-       list of str - paths, related to repo root (if FILE_LIST_DUMP is present)
+@args commit: str - SHA-1 of a commit
+      paths: list of str - pathspecs to limit the listing to, related to repo root
+@return list of str - paths of the files in the commit's tree, related to repo root
+"""
+def list_tree(commit, paths):
+    metrics.count("subprocesses")
+    out = subprocess.check_output(["git", "ls-tree", "-r", "--name-only", "-z", commit, "--"] + paths)
+    return [ path for path in out.decode('utf-8', 'surrogateescape').split('\0') if path ]
+
 """
-def load_staged_deleted_files():
-    if not os.path.isfile(FILE_LIST_DUMP):
+@args old, new: str - SHA-1s of two commits
+@return list of FileStatus or None - changes from old to new (blobs are of new), None if
+                                     they cannot be compared, e.g. old was garbage collected
+"""
+def get_changed_between(old, new):
+    metrics.count("subprocesses")
+    try:
+        out = subprocess.check_output(RAW_DIFF_COMMAND + [old, new, "--"], stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
         return None
-    decorated_files = _load_from_log(FILE_LIST_DUMP)
-    return _get_deleted_from_decorated(decorated_files)
+    return parse_raw(out)
 
-def remove_dumped():
-    if os.path.isfile(FILE_LIST_DUMP):
-        os.remove(FILE_LIST_DUMP)
+"""
+@args paths: list of str - paths related to repo root
+@return dict - key: path, value: SHA-1 of its content in the index (paths not in the index are left out)
+"""
+def get_index_blobs(paths):
+    metrics.count("subprocesses")
+    out = subprocess.check_output(["git", "ls-files", "-s", "-z", "--"] + paths)
+    blobs = {}
+    for entry in out.decode('utf-8', 'surrogateescape').split('\0'):
+        if len(entry) == 0:
+            continue
+        meta, path = entry.split('\t', 1) # "<mode> <sha> <stage>", then the path
+        mode, sha, stage = meta.split(" ")
+        if stage == "0": # not in a merge conflict
+            blobs[path] = sha
+    return blobs
+
+# one hunk of 'git diff -U0', on the new side
+#   start: int - 1-based number of the first line (for a pure deletion, the line before it)
+#   count: int - number of lines, 0 for a pure deletion
+#   added: list of bytes - the added lines, without the newline
+Hunk = collections.namedtuple("Hunk", ["start", "count", "added"])
+
+# explicit prefixes, as diff.noprefix and diff.mnemonicPrefix would change them;
+# no textconv or external diff, so the lines are the file's
+STAGED_HUNKS_COMMAND = ["git", "diff", "--cached", "-U0", "--no-color", "--no-ext-diff", "--no-textconv",
+                        "--src-prefix=a/", "--dst-prefix=b/", "-M"]
+
+def _unquote_path(path):
+    # Git C-quotes paths with special characters, e.g. "b/caf\303\251.cc"
+    if not path.startswith(b'"'):
+        return path
+    return codecs.escape_decode(path[1:-1])[0]
+
+def _count(text):
+    return int(text) if text != None else 1
+
+HUNK_HEADER = re.compile(br"^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+"""
+@args out: bytes - output of STAGED_HUNKS_COMMAND (or 'git diff -U0' with prefixes a/ and b/)
+@return dict - key: path, related to repo root, value: list of Hunk (files deleted or
+               without changed lines, e.g. binary files or pure renames, are left out)
+"""
+def parse_hunks(out):
+    hunks, path, lines = {}, None, out.split(b"\n")
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line.startswith(b"+++ "):
+            target = line[4:-1] if line.endswith(b"\t") else line[4:] # Git ends a path with spaces with a tab
+            target = _unquote_path(target)
+            path = target[2:].decode('utf-8', 'surrogateescape') if target.startswith(b"b/") else None
+            continue
+        match = HUNK_HEADER.match(line)
+        if match == None or path == None:
+            continue
+        old_count, start, count = _count(match.group(1)), int(match.group(2)), _count(match.group(3))
+        added = []
+        remaining = old_count + count
+        while remaining > 0 and i < len(lines): # the body; a line "+++ ..." here is an added line
+            if lines[i].startswith(b"\\"): # "\ No newline at end of file"
+                i += 1
+                continue
+            if lines[i].startswith(b"+"):
+                added.append(lines[i][1:])
+            remaining -= 1
+            i += 1
+        hunks.setdefault(path, []).append(Hunk(start, count, added))
+    return hunks
+
+"""
+@return dict - changed lines of all staged files, see parse_hunks(); one diff for the
+               whole commit, so the cost follows the size of the change, not of the files
+"""
+def get_staged_hunks():
+    metrics.count("subprocesses")
+    return parse_hunks(subprocess.check_output(STAGED_HUNKS_COMMAND))
+
+# Reads blobs from one long-lived 'git cat-file --batch' process, so reading a blob
+# costs a pipe round trip, not a process spawn.
+class BlobReader(object):
+    def __init__(self):
+        metrics.count("subprocesses")
+        self._proc = subprocess.Popen(["git", "cat-file", "--batch"],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    """
+    @args sha: str - SHA-1 of the blob
+    @return bytes - content of the blob
+    """
+    def read(self, sha):
+        self._proc.stdin.write(sha.encode("ascii") + b"\n")
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().split() # "<sha> <type> <size>" or "<sha> missing"
+        if len(header) != 3:
+            raise ValueError("blob not found: %s" % sha)
+        size = int(header[2])
+        metrics.count("bytes_read", size)
+        data = self._proc.stdout.read(size)
+        self._proc.stdout.read(1) # the newline after the content
+        return data
+
+    def close(self):
+        if self._proc.poll() == None:
+            self._proc.stdin.close()
+            self._proc.wait()
+
+_blob_reader = None # one per process, as worker processes cannot share a pipe
+
+"""
+@args sha: str - SHA-1 of the blob
+@return bytes - content of the blob
+"""
+def read_blob(sha):
+    global _blob_reader
+    if _blob_reader == None:
+        _blob_reader = BlobReader()
+        atexit.register(_blob_reader.close)
+    return _blob_reader.read(sha)
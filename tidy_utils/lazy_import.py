@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: lazy_import.py
+# ---------------------------
+# Import a module when one of its attributes is first used, instead of when it is named,
+# so that a run only pays for importing the checkers it gets to.
+
+import sys, importlib.util
+
+"""
+@args name: str - name of the module, as in an import statement
+@return module - loaded on first attribute access; it is put in sys.modules, so that
+                 an import statement elsewhere gets the same module
+"""
+def load(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec == None:
+        raise ImportError("no module named %s" % name, name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: metrics.py
+# ---------------------------
+# Where the time of a run goes: wall time, CPU time and counters (files visited,
+# bytes read, subprocesses spawned) per stage (checker), and per file within a stage.
+#
+# Recording is off unless a Metrics is installed with start() or swap(); until then
+# count(), stage() and file() do next to nothing. A worker process records into its
+# own Metrics, and sends snapshot() back to be merge()d.
+
+import os, time, json, contextlib, collections
+
+COUNTERS = ["files_visited", "bytes_read", "subprocesses"]
+DEFAULT_STAGE = "other"
+
+class Metrics(object):
+    def __init__(self):
+        self.stages = collections.OrderedDict() # key: stage name, value: dict of times and counters
+        self.files = {} # key: stage name, value: dict (key: path, value: dict of times and counters)
+        self.events = [] # spans, in the Trace Event Format (see trace())
+        self.current_stage = DEFAULT_STAGE
+        self.current_file = None # entry of the file being worked on, None if not in file()
+
+    def _stage_entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict([ ("wall", 0.0), ("cpu", 0.0), ("calls", 0) ] + [ (c, 0) for c in COUNTERS ])
+        return self.stages[name]
+
+    def _file_entry(self, name, path):
+        files = self.files.setdefault(name, {})
+        if path not in files:
+            files[path] = dict([ ("wall", 0.0), ("cpu", 0.0) ] + [ (c, 0) for c in COUNTERS ])
+        return files[path]
+
+    def add(self, counter, n=1):
+        self._stage_entry(self.current_stage)[counter] += n
+        if self.current_file != None:
+            self.current_file[counter] += n
+
+    def add_span(self, name, category, start, wall):
+        self.events.append({ "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": 0,
+                             "ts": int(start * 1e6), "dur": int(wall * 1e6) })
+
+    """
+    @return dict - the recorded metrics, serializable to JSON
+    """
+    def snapshot(self):
+        return { "stages": self.stages, "files": self.files, "events": self.events }
+
+    """
+    @args snapshot: dict - returned by snapshot(), e.g. of a worker process
+    """
+    def merge(self, snapshot):
+        for name, entry in snapshot["stages"].items():
+            mine = self._stage_entry(name)
+            for key, value in entry.items():
+                mine[key] += value
+        for name, files in snapshot["files"].items():
+            for path, entry in files.items():
+                mine = self._file_entry(name, path)
+                for key, value in entry.items():
+                    mine[key] += value
+        self.events += snapshot["events"]
+
+    """
+    @args n: int - number of files
+    @return list of (dict, str, str) - times and counters, stage and path, slowest (in wall time) first
+    """
+    def slowest_files(self, n=10):
+        items = [ (entry, name, path) for name, files in self.files.items() for path, entry in files.items() ]
+        return sorted(items, key=lambda item: (-item[0]["wall"], item[1], item[2]))[:n]
+
+    """
+    @args top: int - number of slowest files to list
+    @return str - a table of the stages, then one of the slowest files
+    """
+    def summary(self, top=10):
+        header = ("stage", "calls", "wall(s)", "cpu(s)", "files", "bytes read", "subprocs")
+        rows = [ (name, str(e["calls"]), "%.3f" % e["wall"], "%.3f" % e["cpu"], str(e["files_visited"]),
+                  str(e["bytes_read"]), str(e["subprocesses"])) for name, e in self.stages.items() ]
+        lines = _table(header, rows)
+        slowest = self.slowest_files(top)
+        if len(slowest) > 0:
+            header = ("slowest file", "stage", "wall(s)", "cpu(s)", "bytes read", "subprocs")
+            rows = [ (path, name, "%.3f" % e["wall"], "%.3f" % e["cpu"], str(e["bytes_read"]), str(e["subprocesses"]))
+                     for e, name, path in slowest ]
+            lines += [""] + _table(header, rows)
+        return "\n".join(lines)
+
+    """
+    @return dict - in the Trace Event Format, e.g. for chrome://tracing or Perfetto
+    """
+    def trace(self):
+        return { "traceEvents": sorted(self.events, key=lambda event: event["ts"]), "displayTimeUnit": "ms" }
+
+    """
+    @args path: str - path to the JSON file to write: the snapshot, with the summary of stages
+    """
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({ "stages": self.stages, "files": self.files }, f, indent=2)
+
+    """
+    @args path: str - path to the JSON file to write, see trace()
+    """
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+
+"""
+@args header: tuple of str - column names
+      rows: list of tuple of str - cells, the first column left aligned, the others right aligned
+@return list of str - lines of the table
+"""
+def _table(header, rows):
+    widths = [ max([ len(row[i]) for row in [header] + rows ]) for i in range(len(header)) ]
+    lines = [ "  ".join([ (cell.ljust if i == 0 else cell.rjust)(widths[i]) for i, cell in enumerate(row) ])
+              for row in [header] + rows ]
+    lines.insert(1, "-" * len(lines[0]))
+    return lines
+
+_current = None # the Metrics recorded into by this process, None if not recording
+
+"""
+@return Metrics - a new one, recorded into from now on
+"""
+def start():
+    swap(Metrics())
+    return _current
+
+"""
+@return Metrics or None - the one recorded into so far; recording stops
+"""
+def stop():
+    return swap(None)
+
+"""
+@args metrics: Metrics or None - to be recorded into from now on, None to stop
+@return Metrics or None - the one recorded into so far
+"""
+def swap(metrics):
+    global _current
+    old, _current = _current, metrics
+    return old
+
+"""
+@return Metrics or None - the one being recorded into, if any
+"""
+def active():
+    return _current
+
+"""
+@args counter: str - one of COUNTERS, counted for the current stage
+      n: int - the amount
+"""
+def count(counter, n=1):
+    if _current != None:
+        _current.add(counter, n)
+
+"""
+Time the block as the stage (checker) name; counters inside are counted for it.
+Nested stages are also timed as part of the outer stage.
+"""
+@contextlib.contextmanager
+def stage(name):
+    metrics = _current
+    if metrics == None:
+        yield
+        return
+    outer, metrics.current_stage = metrics.current_stage, name
+    start_wall, start_cpu, start_time = time.perf_counter(), time.process_time(), time.time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        entry = metrics._stage_entry(name)
+        entry["wall"] += wall
+        entry["cpu"] += time.process_time() - start_cpu
+        entry["calls"] += 1
+        metrics.add_span(name, "stage", start_time, wall)
+        metrics.current_stage = outer
+
+"""
+Time the block as work on one file, for the current stage; counters inside are counted
+for the file as well as for the stage.
+"""
+@contextlib.contextmanager
+def file(path):
+    metrics = _current
+    if metrics == None:
+        yield
+        return
+    entry = metrics._file_entry(metrics.current_stage, path)
+    outer, metrics.current_file = metrics.current_file, entry
+    start_wall, start_cpu, start_time = time.perf_counter(), time.process_time(), time.time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        entry["wall"] += wall
+        entry["cpu"] += time.process_time() - start_cpu
+        metrics.add_span(path, metrics.current_stage, start_time, wall)
+        metrics.current_file = outer
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: parallel.py
+# ---------------------------
+# Run independent units of work on a process pool, and collect results in order.
+
+import os, io, contextlib, collections, itertools
+
+"""
+@args jobs: int or None - requested number of jobs, 0 or None means "one per CPU"
+@return int - number of jobs to use, at least 1
+"""
+def resolve_jobs(jobs):
+    if not jobs:
+        return os.cpu_count() or 1
+    return max(1, jobs)
+
+"""
+@args func: callable - a module-level function (so it can be sent to worker processes)
+      items: iterable - each item is passed to func as its only argument
+      jobs: int - number of worker processes, 1 means run in this process
+@return list - results, in the same order as items (not the order of completion)
+"""
+def map_ordered(func, items, jobs=1):
+    items = list(items)
+    jobs = min(resolve_jobs(jobs), len(items))
+    if jobs <= 1:
+        return [ func(item) for item in items ]
+    # hand out a few units at a time to cut pickling round trips, but keep enough
+    # chunks so that one slow unit does not leave other workers idle
+    chunksize = max(1, len(items) // (jobs * 4))
+    from concurrent import futures # only here, as it takes a while to import
+    with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+"""
+@args func: callable - the function to call, which may print to stdout
+@return any - the return value of func
+        str - what func printed, to be replayed by the caller in a deterministic order
+"""
+def call_captured(func, *args, **kwargs):
+    buf = io.StringIO()
+    with contextlib.redirect_stdout(buf):
+        res = func(*args, **kwargs)
+    return res, buf.getvalue()
+
+def _apply_chunk(args):
+    func, chunk = args
+    return [ func(item) for item in chunk ]
+
+"""
+Like map_ordered(), but items are consumed lazily and results are yielded as soon as they
+are ready in order, so memory stays bounded when there are millions of items. If the
+iterator is closed early, the chunks not started yet are not run.
+@args func: callable - a module-level function (so it can be sent to worker processes)
+      items: iterable - each item is passed to func as its only argument
+      jobs: int - number of worker processes, 1 means run in this process
+      chunksize: int - number of items sent to a worker at a time
+@return iterator - results, in the same order as items
+"""
+def imap_ordered(func, items, jobs=1, chunksize=64):
+    jobs = resolve_jobs(jobs)
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    items = iter(items)
+    pending = collections.deque() # futures of chunks, in order
+    from concurrent import futures # only here, as it takes a while to import
+    with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        try:
+            while True:
+                while len(pending) < jobs * 2: # keep every worker busy, but do not read ahead too far
+                    chunk = list(itertools.islice(items, chunksize))
+                    if len(chunk) == 0:
+                        break
+                    pending.append(executor.submit(_apply_chunk, (func, chunk)))
+                if len(pending) == 0:
+                    break
+                for res in pending.popleft().result():
+                    yield res
+        finally:
+            for future in pending:
+                future.cancel()
+
+"""
+Like map_ordered(), but stops at the first result (in order) that stop() is true on, e.g. a
+failure that decides the outcome already; the units not started by then are not run.
+@args func: callable - a module-level function (so it can be sent to worker processes)
+      items: iterable - each item is passed to func as its only argument
+      jobs: int - number of worker processes, 1 means run in this process
+      stop: callable - called on each result in this process, returns bool
+@return list - results, in the same order as items, up to the one stop() is true on
+"""
+def map_until(func, items, jobs, stop):
+    items = list(items)
+    jobs = min(resolve_jobs(jobs), max(1, len(items)))
+    # a chunk is the unit of cancellation, so they are smaller than map_ordered()'s
+    results, iterator = [], imap_ordered(func, items, jobs, chunksize=max(1, len(items) // (jobs * 8)))
+    try:
+        for res in iterator:
+            results.append(res)
+            if stop(res):
+                break
+    finally:
+        iterator.close()
+    return results
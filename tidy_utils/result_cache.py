@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: result_cache.py
+# ---------------------------
+# Remember which file contents passed which checker, so unchanged files are not re-checked.
+# Only works in repo root, not other directories.
+#
+# An entry is an empty file .git/tidy-cache/<2 hex>/<38 hex>, named by the hash of
+# (git blob SHA of the content, checker name, checker config version). Its presence
+# means "clean", and its mtime is the last time it was used, for LRU eviction.
+# Entries are plain files, so worker processes can look up and record them without locking.
+#
+# The number of entries is known without listing them: COUNT_FILE has the number found by
+# the last listing, and a byte is appended to ADDED_LOG for each entry added since. The
+# entries are listed only when that is over the limit, and then evicted well below it.
+
+import os, hashlib
+
+CACHE_DIR = os.path.join(".git", "tidy-cache")
+COUNT_FILE = os.path.join(CACHE_DIR, "count") # number of entries at the last listing, in decimal
+ADDED_LOG = os.path.join(CACHE_DIR, "added") # one byte per entry added since the last listing
+MAX_ENTRIES = 50000
+PRUNE_SLACK = 0.1 # fraction of MAX_ENTRIES evicted beyond the limit, so that listings are rare
+HASH_CHUNK_SIZE = 1 << 20 # 1 MiB
+
+def is_available():
+    return os.path.isdir(".git")
+
+"""
+@args data: bytes - file content
+@return str - the SHA-1 git would give to a blob of this content
+"""
+def blob_sha(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+"""
+@args path: str - path to the file
+@return str - the SHA-1 git would give to a blob of this file's content
+"""
+def file_blob_sha(path):
+    # streamed, so a huge file is not loaded in memory; the blob header needs the size first
+    with open(path, 'rb') as f:
+        sha = hashlib.sha1(b"blob %d\0" % os.fstat(f.fileno()).st_size)
+        while True:
+            block = f.read(HASH_CHUNK_SIZE)
+            if len(block) == 0:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+"""
+@args blob: str - git blob SHA of the content
+      checker: str - name of the checker
+      version: str - version of the checker and its config, bump it when the rules change
+      extra: str - other things the result depends on, e.g. the file name
+@return str - the cache key
+"""
+def make_key(blob, checker, version, extra=""):
+    return hashlib.sha1("\0".join([blob, checker, version, extra]).encode("utf-8")).hexdigest()
+
+"""
+@args path: str - path to the file
+      checker, version, extra: see make_key()
+@return str or None - the cache key, None if the cache is not available or the file is unreadable
+"""
+def key_of_file(path, checker, version, extra=""):
+    if not is_available():
+        return None
+    try:
+        return make_key(file_blob_sha(path), checker, version, extra)
+    except (IOError, OSError):
+        return None
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, key[:2], key[2:])
+
+"""
+@args key: str or None - the cache key
+@return bool - whether the content is known to be clean
+"""
+def lookup(key):
+    if key == None:
+        return False
+    path = _entry_path(key)
+    try:
+        os.utime(path, None) # mark as recently used
+        return True
+    except OSError:
+        return False
+
+"""
+@args key: str or None - the cache key of a content that is clean
+"""
+def record(key):
+    if key == None or not is_available():
+        return
+    path = _entry_path(key)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        # appends of one byte do not interleave, so worker processes need no locking
+        with open(ADDED_LOG, 'ab') as f:
+            f.write(b".")
+    except OSError:
+        pass # recorded already; or the cache is only an optimization
+
+def _read_count():
+    try:
+        with open(COUNT_FILE, 'r') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+"""
+Evict least recently used entries if there are more than max_entries, down to
+max_entries * (1 - PRUNE_SLACK). The entries are not listed unless the counts
+say there are too many, so it costs two small reads if an entry was added.
+"""
+def prune(max_entries=MAX_ENTRIES):
+    try:
+        added = os.path.getsize(ADDED_LOG)
+    except OSError:
+        return # no entry added since the last listing
+    count = _read_count()
+    if count != None and count + added <= max_entries:
+        return
+    entries = []
+    for subdir in os.listdir(CACHE_DIR):
+        subdir_path = os.path.join(CACHE_DIR, subdir)
+        if not os.path.isdir(subdir_path):
+            continue
+        for entry in os.scandir(subdir_path):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError: # evicted meanwhile by another run
+                pass
+    keep = len(entries)
+    if len(entries) > max_entries:
+        keep = max_entries - int(max_entries * PRUNE_SLACK)
+        entries.sort()
+        for _, path in entries[:len(entries) - keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    try:
+        # entries added by another run since the listing are not counted; the limit is not strict
+        os.remove(ADDED_LOG)
+        tmp = COUNT_FILE + ".%d.tmp" % os.getpid()
+        with open(tmp, 'w') as f:
+            f.write("%d" % keep)
+        os.replace(tmp, COUNT_FILE)
+    except OSError:
+        pass
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: run_context.py
+# ---------------------------
+# What one run of the checkers works on, computed once and handed to every checker.
+# Only works in repo root, not other directories.
+#
+# Library callers (e.g. all.py) create a RunContext and pass it along in memory.
+# Standalone scripts run by a hook one after another can share one through a private
+# temporary file, whose path is in the environment variable ENV_VAR (see export()).
+# The file has the output of 'git diff --cached --raw -z --no-abbrev -M', so a shell hook
+# can write it with git alone:
+#   export TIDY_RUN_CONTEXT=$(mktemp) && git diff --cached --raw -z --no-abbrev -M > $TIDY_RUN_CONTEXT
+
+import os
+import tidy_utils.git_utils as git_utils
+
+ENV_VAR = "TIDY_RUN_CONTEXT"
+
+class RunContext(object):
+    """
+    @args staged: list of git_utils.FileStatus - staged changes
+    """
+    def __init__(self, staged):
+        self.staged = staged
+
+    """
+    @return RunContext - from the staged changes of the repo at current working directory
+    """
+    @staticmethod
+    def from_git():
+        return RunContext(git_utils.get_staged_changed())
+
+    """
+    @return RunContext - the exported one, if any (see export()), else from_git()
+    """
+    @staticmethod
+    def for_cli():
+        path = os.environ.get(ENV_VAR)
+        if path and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                staged = git_utils.parse_raw(f.read())
+            return RunContext(sorted(staged, key=lambda item: item.path))
+        return RunContext.from_git()
+
+    """
+    @return list of str - paths of staged created/modified files, related to repo root
+    """
+    def created_or_modified_files(self):
+        return [ item.path for item in self.staged if item.status in git_utils.CREATED_OR_MODIFIED ]
+
+    """
+    @return dict - key: path of a staged created/modified file, value: SHA-1 of its content in the index
+    """
+    def staged_blobs(self):
+        return dict([ (item.path, item.blob) for item in self.staged
+                      if item.status in git_utils.CREATED_OR_MODIFIED and item.blob != None ])
+
+    """
+    @return list of str - paths of staged deleted files, related to repo root
+    """
+    def deleted_files(self):
+        return [ item.path for item in self.staged if item.status == "D" ]
+
+    """
+    Write the context to a private temporary file, and set ENV_VAR to its path, so that
+    scripts started from now on by this process pick it up with for_cli().
+    @return str - path to the temporary file, to be given to remove_export()
+    """
+    def export(self):
+        import tempfile
+        fd, path = tempfile.mkstemp(prefix="tidy-run-context-")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(git_utils.format_raw(self.staged))
+        os.environ[ENV_VAR] = path
+        return path
+
+"""
+@args path: str - returned by RunContext.export()
+"""
+def remove_export(path):
+    if os.environ.get(ENV_VAR) == path:
+        del os.environ[ENV_VAR]
+    if os.path.isfile(path):
+        os.remove(path)
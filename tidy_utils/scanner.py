@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: scanner.py
+# ---------------------------
+# Read a file once, in large binary chunks, and feed it to every rule that is interested.
+# A rule is either line-level (sees all lines) or header-level (sees the first few lines).
+# Header-level rules only see the lines within the first HEADER_PREFIX_SIZE bytes, so that
+# a file with no newlines (e.g. minified) costs no more than a small one if only they are asked.
+#
+# Line endings are handled like Python's text mode (universal newlines): "\r\n" and "\r"
+# are seen as "\n", so line numbers and line contents are the same as with readline().
+
+import os
+import tidy_utils.git_utils as git_utils
+import tidy_utils.metrics as metrics
+import tidy_utils.result_cache as result_cache
+
+CHUNK_SIZE = 1 << 20 # 1 MiB
+HEADER_PREFIX_SIZE = 4096
+
+# Base class of rules. A line-level rule overrides feed_line() (or feed_chunk(), to work
+# on many lines at once); a header-level rule sets header_lines and overrides feed_header().
+class Rule(object):
+    header_lines = None # int: only the first header_lines lines (within the prefix) are needed
+
+    def __init__(self, path):
+        self.path = path
+
+    """
+    @args chunk: bytes - complete lines, each ends with b"\n", except the last line of the file may not
+          first_lineno: int - line number of the first line in chunk, starting from 1
+    """
+    def feed_chunk(self, chunk, first_lineno):
+        lines = chunk.split(b"\n")
+        if lines[-1] == b"":
+            lines.pop()
+        for i, line in enumerate(lines):
+            self.feed_line(first_lineno + i, line)
+
+    """
+    @args lineno: int - line number, starting from 1
+          line: bytes - the line, without b"\n"
+    """
+    def feed_line(self, lineno, line):
+        pass
+
+    """
+    @args lines: list of bytes - the first header_lines lines, without b"\n"; fewer if the file is shorter,
+                 or if they do not end within the first HEADER_PREFIX_SIZE bytes
+    """
+    def feed_header(self, lines):
+        pass
+
+_rule_factories = {} # key: rule name, value: callable (path) -> Rule
+
+"""
+@args name: str - rule name, unique among all checkers
+      factory: callable - takes the file path, returns a new Rule
+"""
+def register_rule(name, factory):
+    if name in _rule_factories and _rule_factories[name] != factory:
+        raise ValueError("rule already registered: %s" % name)
+    _rule_factories[name] = factory
+
+def normalize_newlines(data):
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return data
+
+"""
+@args f: binary file object
+@return iterator of bytes - newline-normalized chunks, each made of complete lines
+"""
+def iter_chunks(f):
+    pending = [] # read, but not ended with a newline yet
+    while True:
+        block = f.read(CHUNK_SIZE)
+        if len(block) == 0:
+            break
+        metrics.count("bytes_read", len(block))
+        cut = block.rfind(b"\n") + 1
+        if cut == 0:
+            pending.append(block)
+            continue
+        chunk = b"".join(pending + [block[:cut]])
+        pending = [block[cut:]] if cut < len(block) else []
+        yield normalize_newlines(chunk)
+    if len(pending) > 0:
+        yield normalize_newlines(b"".join(pending))
+
+def _split_rules(rules):
+    line_rules = [ rule for rule in rules if rule.header_lines == None ]
+    header_rules = [ rule for rule in rules if rule.header_lines != None ]
+    return line_rules, header_rules
+
+"""
+@args header_rules: list of Rule - the header-level rules
+      prefix: bytes - at most the first HEADER_PREFIX_SIZE bytes of the content
+      complete: bool - whether prefix is the whole content
+"""
+def _feed_header(header_rules, prefix, complete):
+    if len(header_rules) == 0:
+        return
+    header_size = max([ rule.header_lines for rule in header_rules ])
+    lines = normalize_newlines(prefix).split(b"\n", header_size)
+    if len(lines) > header_size: # the last item is the rest of the prefix
+        lines.pop()
+    elif lines[-1] == b"" or not complete: # nothing after the last newline, or a line cut by the prefix
+        lines.pop()
+    for rule in header_rules:
+        rule.feed_header(lines[:rule.header_lines])
+
+def _feed_lines(line_rules, chunks):
+    lineno = 1
+    for chunk in chunks:
+        for rule in line_rules:
+            rule.feed_chunk(chunk, lineno)
+        lineno += chunk.count(b"\n")
+
+"""
+@args path: str - path to the file
+      rule_names: list of str - names of the registered rules
+@return dict - key: rule name, value: the Rule fed with the file's content
+"""
+def scan_file(path, rule_names):
+    rules = dict([ (name, _rule_factories[name](path)) for name in rule_names ])
+    line_rules, header_rules = _split_rules(rules.values())
+    with open(path, 'rb') as f:
+        if len(header_rules) > 0:
+            prefix = f.read(HEADER_PREFIX_SIZE + 1) # one more byte tells whether there is more
+            metrics.count("bytes_read", len(prefix))
+            _feed_header(header_rules, prefix[:HEADER_PREFIX_SIZE], len(prefix) <= HEADER_PREFIX_SIZE)
+            f.seek(0)
+        if len(line_rules) > 0:
+            _feed_lines(line_rules, iter_chunks(f))
+    return rules
+
+"""
+@args data: bytes - content of the file
+      path: str - path to the file, given to rules
+      rule_names: list of str - names of the registered rules
+@return dict - key: rule name, value: the Rule fed with the content
+"""
+def scan_buffer(data, path, rule_names):
+    rules = dict([ (name, _rule_factories[name](path)) for name in rule_names ])
+    line_rules, header_rules = _split_rules(rules.values())
+    _feed_header(header_rules, data[:HEADER_PREFIX_SIZE], len(data) <= HEADER_PREFIX_SIZE)
+    if len(line_rules) > 0:
+        _feed_lines(line_rules, [ normalize_newlines(data) ])
+    return rules
+
+# One file, to be read once and scanned once for all rules that will be asked for.
+# Checkers ask for their rules with results(); a checker that does not need its rules
+# (e.g. a cache hit) calls skip(), so the rules are left out of the scan.
+# The content is either the file in the work tree, or a blob (e.g. the staged content).
+class ScannedFile(object):
+    """
+    @args path: str - path to the file
+          wanted: list of str - names of the rules that are going to be asked for
+          blob: str or None - SHA-1 of the blob to read from git instead of the work tree
+    """
+    def __init__(self, path, wanted=(), blob=None):
+        self.path = path
+        self.in_work_tree = blob == None
+        self._wanted = list(wanted)
+        self._data = None
+        self._blob_sha = blob
+        self._results = {}
+
+    def data(self):
+        if self._data == None:
+            if self.in_work_tree:
+                with open(self.path, 'rb') as f:
+                    self._data = f.read()
+                metrics.count("bytes_read", len(self._data))
+            else:
+                self._data = git_utils.read_blob(self._blob_sha)
+        return self._data
+
+    def blob_sha(self):
+        if self._blob_sha == None:
+            size = os.path.getsize(self.path) if self._data == None else 0 # else, in memory already
+            if size > CHUNK_SIZE:
+                # too large to keep in memory: hashed in a streamed read, and if the rules are
+                # asked for, streamed again through them by results()
+                self._blob_sha = result_cache.file_blob_sha(self.path)
+                metrics.count("bytes_read", size)
+            else:
+                self._blob_sha = result_cache.blob_sha(self.data())
+        return self._blob_sha
+
+    def skip(self, rule_names):
+        self._wanted = [ name for name in self._wanted if name not in rule_names ]
+
+    """
+    @args rule_names: list of str - names of the registered rules
+    @return dict - key: rule name, value: the Rule fed with the file's content
+    """
+    def results(self, rule_names):
+        missing = [ name for name in rule_names if name not in self._results ]
+        if len(missing) > 0:
+            missing += [ name for name in self._wanted if name not in self._results and name not in missing ]
+            if self._data != None or not self.in_work_tree:
+                self._results.update(scan_buffer(self.data(), self.path, missing))
+            else: # stream it, the content is not needed in memory
+                self._results.update(scan_file(self.path, missing))
+        return dict([ (name, self._results[name]) for name in rule_names ])
@@ -5,23 +5,88 @@
 # File: should_visit.py
 # ---------------------------
 # Check if a file should be inspected based on the file type.
+#
+# The rules are compiled once into regexes, and results are memoized, as the same path
+# is asked for by several checkers. Extra include/exclude globs can be configured with
+# configure(); they are kept in the environment variable ENV_VAR, so that worker
+# processes build the same filter.
 
-import os
+import os, re, fnmatch, functools, json
 
 should_not_visit_dirs = ["xeno/", "test-inputs/", "test-expected/", "zen/", "docs/"]
+should_visit_suffixes = [".h", ".c", ".cc", ".cpp", ".js"]
 
-def should_visit(path):
-    filename = os.path.abspath(path)
-    for dirname in should_not_visit_dirs:
-        if dirname in filename:
+ENV_VAR = "TIDY_PATH_FILTER"
+MEMO_SIZE = 1 << 16
+
+def _any_of(patterns):
+    return "|".join(patterns) if len(patterns) > 0 else "(?!)" # "(?!)" never matches
+
+class PathFilter(object):
+    """
+    @args exclude_dirs: list of str - a path is excluded if it contains one of them, e.g. "xeno/"
+          suffixes: list of str - a path is visited if it ends with one of them
+          include_globs: list of str - fnmatch-style globs of paths to visit regardless of suffixes
+          exclude_globs: list of str - fnmatch-style globs of paths never to visit
+          ('*' in a glob also matches '/', as in Git's pathspecs)
+    """
+    def __init__(self, exclude_dirs=should_not_visit_dirs, suffixes=should_visit_suffixes,
+                 include_globs=(), exclude_globs=()):
+        self.exclude_dirs = list(exclude_dirs)
+        self.exclude_globs = list(exclude_globs)
+        self.include_globs = list(include_globs)
+        self.suffixes = tuple(suffixes)
+        self._excluded_dir = re.compile(_any_of([ re.escape(d) for d in exclude_dirs ]))
+        self._excluded_glob = re.compile(_any_of([ fnmatch.translate(g) for g in exclude_globs ]))
+        self._included_glob = re.compile(_any_of([ fnmatch.translate(g) for g in include_globs ]))
+        self._memoized = functools.lru_cache(maxsize=MEMO_SIZE)(self._should_visit)
+
+    def _should_visit(self, path):
+        if self.is_excluded(path):
             return False
+        return path.endswith(self.suffixes) or self._included_glob.match(path) != None
+
+    """
+    @args path: str - path to the file, related to repo root
+    @return bool - whether the file should be inspected
+    """
+    def should_visit(self, path):
+        return self._memoized(path)
 
-    if filename.endswith(".h"):
-        return True
-    elif filename.endswith(".c") or filename.endswith(".cc") or filename.endswith(".cpp"):
-        return True
-    elif filename.endswith(".js"):
-        return True
+    """
+    @args path: str - path to the file, related to repo root
+    @return bool - whether the file is excluded, by a directory or a glob, regardless of its type
+    """
+    def is_excluded(self, path):
+        if path.startswith("./"):
+            path = path[2:]
+        return self._excluded_dir.search(path) != None or self._excluded_glob.match(path) != None
 
-    # all else..
-    return False
\ No newline at end of file
+    """
+    @args dirpath: str - path to a directory, related to repo root
+    @return bool - whether nothing under the directory should be inspected
+    """
+    def is_excluded_dir(self, dirpath):
+        return self._excluded_dir.search(dirpath + "/") != None
+
+_default_filter = None
+
+def default_filter():
+    global _default_filter
+    if _default_filter == None:
+        config = json.loads(os.environ.get(ENV_VAR, "{}"))
+        _default_filter = PathFilter(include_globs=config.get("include", []),
+                                     exclude_globs=config.get("exclude", []))
+    return _default_filter
+
+"""
+@args include_globs: list of str - fnmatch-style globs of paths to visit regardless of file type
+      exclude_globs: list of str - fnmatch-style globs of paths never to visit
+"""
+def configure(include_globs=(), exclude_globs=()):
+    global _default_filter
+    os.environ[ENV_VAR] = json.dumps({ "include": list(include_globs), "exclude": list(exclude_globs) })
+    _default_filter = None
+
+def should_visit(path):
+    return default_filter().should_visit(path)
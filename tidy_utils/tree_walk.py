@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright: see README and LICENSE under the project root directory.
+# Author: Haihong Li
+#
+# File: tree_walk.py
+# ---------------------------
+# List all files of a tree, for a full audit rather than staged files only.
+# Directories excluded by should_visit are pruned up front instead of being
+# walked and then rejected file by file (unless a checker that does not go by
+# should_visit asks for them, e.g. filename_match), and paths are yielded as they are found.
+
+import os, subprocess
+import tidy_utils.should_visit as should_visit
+import tidy_utils.metrics as metrics
+
+"""
+@args root: str - path to the directory
+      prune: bool - leave out the paths excluded by should_visit
+@return iterator of str - paths to files under root, without a leading "./"
+"""
+def walk_files(root=".", prune=True):
+    # os.scandir() gives each entry's type from the directory listing itself,
+    # so there is no stat per entry, unlike os.walk() + os.path.isdir()
+    path_filter = should_visit.default_filter() if prune else should_visit.PathFilter([], [])
+    stack = [root]
+    while len(stack) > 0:
+        dirpath = stack.pop()
+        try:
+            entries = sorted(os.scandir(dirpath), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            path = entry.path[2:] if entry.path.startswith("./") else entry.path
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != ".git" and not path_filter.is_excluded_dir(path):
+                    subdirs.append(path)
+            elif entry.is_file() and not path_filter.is_excluded(path):
+                yield path
+        stack += reversed(subdirs) # depth-first, in name order
+
+"""
+@args prune: bool - leave out the paths excluded by should_visit
+@return iterator of str - paths to the files tracked by git, related to repo root
+"""
+def git_files(prune=True):
+    # let git leave out most excluded paths, e.g. ":(exclude,glob)**/xeno/**"
+    path_filter = should_visit.default_filter() if prune else should_visit.PathFilter([], [])
+    excludes = [ ":(exclude,glob)**/%s**" % dirname for dirname in path_filter.exclude_dirs ]
+    excludes += [ ":(exclude)%s" % glob for glob in path_filter.exclude_globs ]
+    metrics.count("subprocesses")
+    proc = subprocess.Popen(["git", "ls-files", "-z", "--", "."] + excludes, stdout=subprocess.PIPE)
+    rest = b""
+    while True:
+        block = proc.stdout.read(1 << 16)
+        if len(block) == 0:
+            break
+        paths = (rest + block).split(b"\0")
+        rest = paths.pop()
+        for path in paths:
+            path = path.decode('utf-8', 'surrogateescape')
+            if not path_filter.is_excluded(path):
+                yield path
+    proc.wait()
+
+"""
+@args root: str - path to the directory
+      prune: bool - leave out the paths excluded by should_visit
+@return iterator of str - paths to the files to audit: tracked files if root is
+                          a Git repository's root, else all files under root
+"""
+def iter_files(root=".", prune=True):
+    if os.path.abspath(root) == os.path.abspath(".") and os.path.isdir(".git"):
+        return git_files(prune)
+    return walk_files(root, prune)
@@ -5,61 +5,244 @@
 # File: whitespace.py
 # ---------------------------
 # Check whitespace discipline of one file or a repo.
-# NOTE it only runs on git-staged files, and it does NOT modify files.
+# NOTE it only runs on git-staged files, and it does NOT modify files, unless with '--fix'.
+# With '--changed-lines-only', only the lines added by the staged hunks are checked,
+# taken from one 'git diff --cached -U0' for the whole commit.
+# With '--fix', the files with errors are rewritten, in one streaming pass through a
+# temporary file that replaces the file: tabs are expanded and trailing whitespace is
+# stripped. Fixed staged files are restaged.
 
 import os, sys
+import tidy_utils.diagnostics as diagnostics
 import tidy_utils.git_utils as git_utils
+import tidy_utils.metrics as metrics
+import tidy_utils.run_context as run_context
 import tidy_utils.should_visit as should_visit
+import tidy_utils.result_cache as result_cache
+import tidy_utils.scanner as scanner
+import tidy_utils.tree_walk as tree_walk
+
+CACHE_VERSION = "2" # bump it when the rules change
+DEFAULT_TAB_WIDTH = 4
+
+# rules fed by tidy_utils.scanner, see RULE_NAMES
+# They work on whole chunks of bytes: bytes.find() and bytes.count() run in C, and
+# a line number is only computed for a line that has an error.
+
+# ASCII whitespace of str.rstrip(), except newlines ("\r" is normalized away by the scanner);
+# they are all translated to " ", so one search of b" \n" finds trailing whitespace
+TRAILING_WHITESPACE_CHARS = (b" ", b"\t", b"\x0b", b"\x0c", b"\x1c", b"\x1d", b"\x1e", b"\x1f")
+TRAILING_WHITESPACE = b"".join(TRAILING_WHITESPACE_CHARS)
+# non-ASCII bytes are translated to b"\x80" in the same pass: a line that ends with a non-ASCII
+# character may end with whitespace in UTF-8 (e.g. U+00A0, U+0085, U+3000), and only such a
+# line is decoded, see strip_trailing()
+NON_ASCII = b"\x80"
+TO_SPACE = bytes.maketrans(TRAILING_WHITESPACE[1:] + bytes(range(0x80, 0x100)),
+                           b" " * (len(TRAILING_WHITESPACE) - 1) + NON_ASCII * 0x80)
+
+"""
+@args: line: bytes - a line, without the newline
+@return: bytes - the line without trailing whitespace, as str.rstrip() of the line in UTF-8
+"""
+def strip_trailing(line):
+    stripped = line.rstrip(TRAILING_WHITESPACE)
+    if stripped[-1:] >= b"\x80":
+        # bytes that are not UTF-8 are kept as they are, and are not whitespace
+        stripped = stripped.decode("utf-8", "surrogateescape").rstrip().encode("utf-8", "surrogateescape")
+    return stripped
+
+class TabRule(scanner.Rule):
+    def __init__(self, path):
+        scanner.Rule.__init__(self, path)
+        self.errors = [] # list of (line number, tab count)
+
+    def feed_chunk(self, chunk, first_lineno):
+        pos = chunk.find(b"\t")
+        lineno, counted = first_lineno, 0 # line number at offset 'counted'
+        while pos != -1:
+            line_end = chunk.find(b"\n", pos)
+            if line_end == -1:
+                line_end = len(chunk)
+            lineno += chunk.count(b"\n", counted, pos)
+            counted = pos
+            self.errors.append((lineno, chunk.count(b"\t", pos, line_end)))
+            pos = chunk.find(b"\t", line_end)
+
+class TrailingWhitespaceRule(scanner.Rule):
+    def __init__(self, path):
+        scanner.Rule.__init__(self, path)
+        self.errors = [] # list of line numbers
+
+    def feed_chunk(self, chunk, first_lineno):
+        spaced = chunk.translate(TO_SPACE)
+        pos = spaced.find(b" \n")
+        lineno, counted = first_lineno, 0 # line number at offset 'counted'
+        while pos != -1:
+            lineno += chunk.count(b"\n", counted, pos)
+            counted = pos
+            self.errors.append(lineno)
+            pos = spaced.find(b" \n", pos + 2)
+        # the last line of the file may not end with a newline
+        if chunk[-1:] in TRAILING_WHITESPACE_CHARS:
+            self.errors.append(lineno + chunk.count(b"\n", counted))
+        # the lines that end with a non-ASCII character, which the search above does not see
+        if chunk.isascii(): # as most are, and it is faster to tell than to search
+            return
+        lineno, counted = first_lineno, 0
+        for end in _non_ascii_line_ends(spaced):
+            start = chunk.rfind(b"\n", 0, end) + 1
+            if len(strip_trailing(chunk[start:end])) != end - start:
+                lineno += chunk.count(b"\n", counted, start)
+                counted = start
+                self.errors.append(lineno)
+
+def _non_ascii_line_ends(spaced):
+    # offsets right after the lines (in a chunk translated with TO_SPACE) that end with a non-ASCII byte
+    pos = spaced.find(NON_ASCII + b"\n")
+    while pos != -1:
+        yield pos + 1
+        pos = spaced.find(NON_ASCII + b"\n", pos + 2)
+    if spaced[-1:] == NON_ASCII: # the last line of the file may not end with a newline
+        yield len(spaced)
+
+# NOTE there is no rule for a missing newline at the end of file: it is deactivated
+# to indulge clang-format's behavior of removing last newline
+
+scanner.register_rule("whitespace.tab", TabRule)
+scanner.register_rule("whitespace.trailing", TrailingWhitespaceRule)
+RULE_NAMES = ["whitespace.tab", "whitespace.trailing"]
+
+# "- <kind>: <message> on line <n>", in the details of the printout
+HUMAN_KINDS = { "whitespace.tab": "Tab", "whitespace.trailing": "Whitespace" }
+
+def _diagnostics(filename, tab_errors, trailing_errors):
+    # on the same line, a tab error goes before a trailing whitespace error
+    items = [ (lineno, 0, tab_count) for lineno, tab_count in tab_errors ]
+    items += [ (lineno, 1, None) for lineno in trailing_errors ]
+    for lineno, kind, tab_count in sorted(items):
+        if kind == 0:
+            yield diagnostics.Diagnostic("whitespace", filename, lineno, "whitespace.tab",
+                                         "%d tab%s" % (tab_count, 's' if tab_count > 1 else ''))
+        else:
+            yield diagnostics.Diagnostic("whitespace", filename, lineno, "whitespace.trailing", "trailing whitespaces")
+
+"""
+The file is recorded in the result cache if it has no problem (once all are taken).
+@args: filename: str - path to an existing file to be visited
+       use_cache: bool - skip the file if its content is known to be clean
+       scanned: tidy_utils.scanner.ScannedFile or None - the file, if it is shared with other checkers
+@return: iterator of tidy_utils.diagnostics.Diagnostic - the problems, in line order
+"""
+def diagnose_file(filename, use_cache=True, scanned=None):
+    if scanned == None:
+        scanned = scanner.ScannedFile(filename)
+    cache_key = None
+    if use_cache and result_cache.is_available():
+        cache_key = result_cache.make_key(scanned.blob_sha(), "whitespace", CACHE_VERSION)
+    if result_cache.lookup(cache_key):
+        scanned.skip(RULE_NAMES)
+        return
+
+    rules = scanned.results(RULE_NAMES)
+    num_error = 0
+    for d in _diagnostics(filename, rules["whitespace.tab"].errors, rules["whitespace.trailing"].errors):
+        num_error += 1
+        yield d
+    if num_error == 0:
+        result_cache.record(cache_key)
+
+"""
+@args: filename: str - path to file, related to repo root
+       hunks: list of tidy_utils.git_utils.Hunk - staged hunks of the file
+@return: iterator of tidy_utils.diagnostics.Diagnostic - the problems in the lines added by the hunks
+"""
+def diagnose_hunks(filename, hunks):
+    tab_rule, trailing_rule = TabRule(filename), TrailingWhitespaceRule(filename)
+    for hunk in hunks:
+        if len(hunk.added) == 0:
+            continue
+        # with -U0, the added lines of a hunk are consecutive, from line hunk.start
+        chunk = b"".join([ (line[:-1] if line.endswith(b"\r") else line) + b"\n" for line in hunk.added ])
+        tab_rule.feed_chunk(chunk, hunk.start)
+        trailing_rule.feed_chunk(chunk, hunk.start)
+    return _diagnostics(filename, tab_rule.errors, trailing_rule.errors)
 
 """
 @args: filename: str - path to file
        silent_if_ok: bool - no printing if no error
        details: bool - whether details need to be printed
+       use_cache: bool - skip the file if its content is known to be clean
+       scanned: tidy_utils.scanner.ScannedFile or None - the file, if it is shared with other checkers
+       found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
 @return: bool - whether the file passes
          int  - number of errors
 """
-def check_file(filename, silent_if_ok=False, details=False):
+def check_file(filename, silent_if_ok=False, details=False, use_cache=True, scanned=None, found=None):
+    if not should_visit.should_visit(filename):
+        if not silent_if_ok:
+            print("\tskip %s" % filename)
+        return True, 0 # assume it is passed
+
+    metrics.count("files_visited")
+    if scanned == None:
+        scanned = scanner.ScannedFile(filename)
+    if scanned.in_work_tree:
+        if os.path.isdir(filename):
+            print("[Error] path %s is a directory" % filename)
+            raise ValueError
+        if not os.path.isfile(filename):
+            # file not found, assume it is because the file is deleted rather than created/modified
+            return True, 0
+    problems = list(diagnose_file(filename, use_cache, scanned))
+    if found != None:
+        found += problems
+    return _report(filename, problems, silent_if_ok, details)
+
+"""
+@args: filename: str - path to file, related to repo root
+       hunks: list of tidy_utils.git_utils.Hunk - staged hunks of the file
+       silent_if_ok: bool - no printing if no error
+       details: bool - whether details need to be printed
+       found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
+@return: bool - whether the lines added by the hunks pass
+         int  - number of errors
+"""
+def check_hunks(filename, hunks, silent_if_ok=False, details=False, found=None):
     if not should_visit.should_visit(filename):
         if not silent_if_ok:
             print("\tskip %s" % filename)
         return True, 0 # assume it is passed
 
-    if os.path.isdir(filename):
-        print("[Error] path %s is a directory" % filename)
-        raise ValueError
-    if not os.path.isfile(filename):
-        # file not found, assume it is because the file is deleted rather than created/modified
-        return True, 0
-
-    num_error, num_line, errors = 0, 0, []
-    with open(filename, 'r') as f: # read-only
-        line = ""
-        prev_line = ""
-        while True:
-            line = f.readline()
-            if len(line) == 0: # end of file
-                break
-            num_line += 1
-            tab_count = line.count('\t') # for '\t'
-            if tab_count != 0:
-                num_error += 1
-                if details:
-                    errors.append("- Tab: %d tab%s on line %d" % (tab_count, 's' if tab_count > 1 else '', num_line))
-            if len(line.rstrip()) != len(line.rstrip('\n')): # for trailing whitespaces
-                num_error += 1
-                if details:
-                    errors.append("- Whitespace: trailing whitespaces on line %d" % num_line)
-            prev_line = line
-
-        if prev_line != "" and prev_line != "\n":
-            pass # deactivated to indulge clang-format's behavior of removing last newline
-            # num_error += 1
-            # if details:
-            #     errors.append("- Newline missing: the last line is not \"\\n\"")
+    metrics.count("files_visited")
+    problems = list(diagnose_hunks(filename, hunks))
+    if found != None:
+        found += problems
+    return _report(filename, problems, silent_if_ok, details, " --changed-lines-only")
+
+"""
+Print and return as check_file() does, for problems found before, e.g. by all.py's watcher.
+@args: filename: str - path to file
+       problems: list of tidy_utils.diagnostics.Diagnostic or None - None if the file is not to be visited
+       silent_if_ok: bool - no printing if no error
+       details: bool - whether details need to be printed
+@return: bool - whether the file passes
+         int  - number of errors
+"""
+def report_found(filename, problems, silent_if_ok=False, details=False):
+    if problems == None:
+        if not silent_if_ok:
+            print("\tskip %s" % filename)
+        return True, 0 # assume it is passed
+    return _report(filename, problems, silent_if_ok, details)
+
+def _report(filename, problems, silent_if_ok, details, details_options=""):
+    num_error, errors = len(problems), []
+    if details:
+        errors = [ "- %s: %s on line %d" % (HUMAN_KINDS[d.code], d.message, d.line) for d in problems ]
 
     if num_error > 0 and not details:
         errors.append("\t- %d whitespace error%s in file %s" % (num_error, 's' if num_error > 1 else '', filename))
-        errors.append("\t  for details: %s %s -d" % ("utils/tidy/whitespace.py", filename))
+        errors.append("\t  for details: %s %s -d%s" % ("utils/tidy/whitespace.py", filename, details_options))
 
     if silent_if_ok and num_error == 0:
         pass
@@ -74,29 +257,155 @@ def check_file(filename, silent_if_ok=False, details=False):
 @args: target: str - path to target (repo or file)
        silent_if_ok: bool - no printing if no error
        details: bool - whether details need to be printed
+       use_cache: bool - skip files whose contents are known to be clean
+       context: tidy_utils.run_context.RunContext or None - staged changes, None to ask git
+       changed_lines_only: bool - check only the lines added by the staged hunks (needs .git)
+       found: list or None - if a list, the problems (tidy_utils.diagnostics.Diagnostic) are appended to it
 @return: bool - whether the target passes
          int  - number of errors (file: whitespace errors; repo: number of bad files)
 """
-def check(target, silent_if_ok=False, details=False):
+def check(target, silent_if_ok=False, details=False, use_cache=True, context=None, changed_lines_only=False,
+          found=None):
+    hunks = git_utils.get_staged_hunks() if changed_lines_only and os.path.isdir(".git") else None
     if os.path.isfile(target):
-        return check_file(target, silent_if_ok, details)
+        if hunks != None:
+            return check_hunks(os.path.normpath(target), hunks.get(os.path.normpath(target), []), silent_if_ok, details,
+                               found)
+        return check_file(target, silent_if_ok, details, use_cache, found=found)
 
     filepaths = []
     if os.path.isdir(".git"): # .git is present
-        filepaths = git_utils.load_staged_created_or_modified_files()
-        if filepaths == None:
-            filepaths = git_utils.get_staged_created_or_modified_files()
+        if context == None:
+            context = run_context.RunContext.from_git()
+        filepaths = context.created_or_modified_files()
     else: # .git is missing
-        for dirpath, _, filenames in os.walk(target):
-            for filename in filenames:
-                filepaths.append(os.path.join(dirpath, filename))
+        filepaths = tree_walk.walk_files(target)
 
     bad_file_count = 0
     for path in filepaths:
-        if check_file(path, silent_if_ok, details)[0] == False:
+        if hunks != None:
+            passed = check_hunks(path, hunks.get(path, []), silent_if_ok, details, found)[0]
+        else:
+            passed = check_file(path, silent_if_ok, details, use_cache, found=found)[0]
+        if passed == False:
             bad_file_count += 1
     return True if bad_file_count == 0 else False, bad_file_count
 
+"""
+@args: line: bytes - a line, possibly ending with a newline
+       tab_width: int - a tab is expanded to the next column that is a multiple of tab_width
+@return: bytes - the line, with tabs expanded and trailing whitespace stripped
+"""
+def fix_line(line, tab_width=DEFAULT_TAB_WIDTH):
+    body = line.rstrip(b"\r\n")
+    # a lone "\r" ends a line too, see tidy_utils/scanner.py
+    pieces = [ strip_trailing(piece.expandtabs(tab_width)) for piece in body.split(b"\r") ]
+    return b"\r".join(pieces) + line[len(body):]
+
+"""
+Rewrite the file in one streaming pass, through a temporary file next to it, which replaces
+the file (atomically, keeping its mode) only if the content is changed.
+@args: filename: str - path to the file
+       tab_width: int - a tab is expanded to the next column that is a multiple of tab_width
+       lines: set of int or None - numbers (starting from 1) of the lines to fix, None for all lines
+@return: set of int - numbers of the lines changed, empty if the file is not changed
+"""
+def fix_file(filename, tab_width=DEFAULT_TAB_WIDTH, lines=None):
+    import shutil, tempfile
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                     prefix=".%s." % os.path.basename(filename), suffix=".tmp")
+    changed = set()
+    try:
+        with open(filename, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            for lineno, line in enumerate(src, 1):
+                if lines == None or lineno in lines:
+                    fixed = fix_line(line, tab_width)
+                    if fixed != line:
+                        changed.add(lineno)
+                        line = fixed
+                dst.write(line)
+        if len(changed) > 0:
+            shutil.copymode(filename, temp_path)
+            os.replace(temp_path, filename)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return changed
+
+"""
+@args: target: str - path to target (repo or file)
+       silent_if_ok: bool - no printing if no error
+       use_cache: bool - skip files whose contents are known to be clean
+       context: tidy_utils.run_context.RunContext or None - staged changes, None to ask git
+       changed_lines_only: bool - fix only the lines added by the staged hunks (needs .git)
+       tab_width: int - a tab is expanded to the next column that is a multiple of tab_width
+@return: bool - whether the files are fixed (and restaged, if they are staged files)
+         int  - number of files fixed
+"""
+def fix(target, silent_if_ok=False, use_cache=True, context=None, changed_lines_only=False,
+        tab_width=DEFAULT_TAB_WIDTH):
+    hunks = git_utils.get_staged_hunks() if changed_lines_only and os.path.isdir(".git") else None
+    staged = False
+    if os.path.isfile(target):
+        filepaths = [ os.path.normpath(target) ]
+    elif os.path.isdir(".git"): # .git is present
+        if context == None:
+            context = run_context.RunContext.from_git()
+        filepaths = context.created_or_modified_files()
+        staged = True
+    else: # .git is missing
+        filepaths = tree_walk.walk_files(target)
+
+    # the hunks' line numbers are of the staged content, and restaging adds the whole work tree
+    # file, so a file with unstaged changes is left alone, lest they are fixed wrong or committed
+    unstaged = set()
+    if (staged or hunks != None) and os.path.isdir(".git"):
+        unstaged = set([ item.path for item in git_utils.get_unstaged_changed() ])
+
+    fixed, failed = [], False
+    for path in filepaths:
+        if not should_visit.should_visit(path):
+            if not silent_if_ok:
+                print("\tskip %s" % path)
+            continue
+        if not os.path.isfile(path):
+            continue # deleted
+        if path in unstaged:
+            print("\tskip %s: it has unstaged changes, stage or stash them first" % path)
+            failed = True
+            continue
+        metrics.count("files_visited")
+        if hunks != None:
+            problems = list(diagnose_hunks(path, hunks.get(path, [])))
+        else:
+            problems = list(diagnose_file(path, use_cache))
+        changed_lines = set()
+        if len(problems) > 0:
+            try:
+                # with hunks, the other lines are left as they are
+                changed_lines = fix_file(path, tab_width, set([ d.line for d in problems ]) if hunks != None else None)
+            except OSError as e:
+                print("[Error] failed to fix %s: %s" % (path, e))
+                failed = True
+                continue
+            if len(changed_lines) > 0:
+                fixed.append(path)
+        if silent_if_ok and len(problems) == 0:
+            continue
+        print("\tvisit %s" % path)
+        fixed_count = len([ d for d in problems if d.line in changed_lines ])
+        if fixed_count > 0:
+            print("\t- fixed %d whitespace error%s in file %s" % (fixed_count, 's' if fixed_count > 1 else '', path))
+        if fixed_count < len(problems):
+            print("[Error] %d whitespace error%s not fixed in file %s" %
+                  (len(problems) - fixed_count, 's' if len(problems) - fixed_count > 1 else '', path))
+            failed = True
+
+    if staged and len(fixed) > 0 and not git_utils.add(fixed):
+        print("[Error] error at re-running 'git add' after fixing whitespace")
+        failed = True
+    return not failed, len(fixed)
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(
@@ -108,9 +417,28 @@ def main():
     parser.add_argument("target", nargs=1, help="path to repo directory or one file")
     parser.add_argument("-d", "--details", action="store_true", help="print details of error")
     parser.add_argument("-s", "--silent", action="store_true", help="no printing if no error is encountered")
+    parser.add_argument("--no-cache", action="store_true", help="re-check files even if they are known to be clean")
+    parser.add_argument("--changed-lines-only", action="store_true",
+                        help="check only the lines added by the staged hunks\n(from 'git diff --cached -U0')")
+    parser.add_argument("--fix", action="store_true",
+                        help="fix the errors: expand tabs and strip trailing whitespace,\n" +
+                             "then restage the fixed files if they are staged files")
+    parser.add_argument("--tab-width", type=int, default=DEFAULT_TAB_WIDTH, metavar="N",
+                        help="with --fix, expand tabs to multiples of N columns (default: %d)" % DEFAULT_TAB_WIDTH)
     args = parser.parse_args()
 
-    passed = check(target=args.target[0], silent_if_ok=args.silent, details=args.details)[0]
+    target = args.target[0]
+    context = run_context.RunContext.for_cli() if os.path.isdir(".git") and not os.path.isfile(target) else None
+    if args.fix:
+        if args.tab_width < 1:
+            print("[Error] --tab-width should be at least 1")
+            return 1
+        passed = fix(target, args.silent, not args.no_cache, context, args.changed_lines_only, args.tab_width)[0]
+        result_cache.prune()
+        return 0 if passed else 1
+    passed = check(target=target, silent_if_ok=args.silent, details=args.details,
+                   use_cache=not args.no_cache, context=context, changed_lines_only=args.changed_lines_only)[0]
+    result_cache.prune()
     return 0 if passed else 1
 
 if __name__ == "__main__":